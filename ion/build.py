@@ -27,17 +27,22 @@ To add a new build type:
   4. decorate it with @RegisterBuilder.
 """
 
+from __future__ import print_function
+
 import argparse
+import ast
 import collections
+import concurrent.futures
 import getpass
 import hashlib
 import itertools
 import json
+import locale
 import multiprocessing
-import multiprocessing.dummy
 import os
 import platform
 import shutil
+import stat
 import subprocess
 import sys
 
@@ -56,6 +61,13 @@ NINJA_LINUX_BINARY_PATH = os.path.join(NINJA_DIR, 'ninja-linux64')
 NINJA_MAC_BINARY_PATH = os.path.join(NINJA_DIR, 'ninja-mac')
 NINJA_WINDOWS_BINARY_PATH = os.path.join(NINJA_DIR, 'ninja.exe')
 
+# Maps host OSes to the ninja binary for that host.
+NINJA_BINARY_PATHS = {
+    'linux': NINJA_LINUX_BINARY_PATH,
+    'mac': NINJA_MAC_BINARY_PATH,
+    'win': NINJA_WINDOWS_BINARY_PATH,
+}
+
 # The path to LLVM, used in the asmjs builder.  Currently works on Linux only.
 LLVM_PATH = os.path.abspath(os.path.join(
     ROOT_DIR, 'third_party/emscripten/llvm-bin'))
@@ -121,6 +133,18 @@ except ImportError:
 
   colorama = FakeColorama()
 
+# Colored test result prefixes. The color codes are constants, so these are
+# formatted once here rather than by every test worker.
+_TEST_FAILED_PREFIX = '{red}FAILED: '.format(red=colorama.Fore.RED)
+_TEST_PASSED_PREFIX = '{green}PASSED: {reset}'.format(
+    green=colorama.Fore.GREEN, reset=colorama.Fore.RESET)
+
+# Colored prefixes for ExitWithError and PrintStatus.
+_ERROR_PREFIX = '{red}ERROR:{reset} '.format(
+    red=colorama.Fore.RED, reset=colorama.Fore.RESET)
+_STATUS_PREFIX = '{green}INFO: {reset}'.format(
+    green=colorama.Fore.GREEN, reset=colorama.Fore.RESET)
+
 
 # In order to use pymod_do_main, we need to add the path to the module(s) to
 # sys.path so that python can find them. Right now, they exist in ./dev.
@@ -134,64 +158,81 @@ GYP_OUT_DIR = os.path.abspath(os.path.join(ROOT_DIR, 'gyp-out'))
 GYP_PROJECTS_DIR = os.path.abspath(
     os.path.join(ROOT_DIR, 'gyp-projects/build'))
 
+# Results of _FindNearestFiles, keyed by (directory, filename_to_find,
+# root_dir). Each directory probed by a search is cached, so later searches
+# starting from any of them do not need to stat anything.
+_NEAREST_FILE_CACHE = {}
+
+# Parsed gypi files, keyed by path. See _LoadGypi.
+_GYPI_CACHE = {}
+
+# Code objects for the predicates of gypi 'conditions', keyed by source. See
+# _EvalGypPredicate.
+_PREDICATE_CODE_CACHE = {}
+
+# Maps the values of platform.system() to the host OS names used by builders.
+_HOST_OS_NAMES = {
+    'Darwin': 'mac',
+    'Linux': 'linux',
+    'Windows': 'win',
+}
 
-def _AsyncSubprocess(stdout_lock, test_target, command_args, is_verbose):
-  """Run the command line using subprocess, queueing the output.
+# The result of GetHostOS, once it has been computed.
+_HOST_OS = None
 
-  This exists as a top-level function to be compliant with how
-  multiprocessing.apply_async works (everything must be pickleable, which
-  instance methods are not).
 
-  Standard output of the command is buffered and printed after the command runs
-  in case of failure, or if is_verbose.
+def _AsyncSubprocess(command_args):
+  """Run the command line using subprocess, collecting its output.
+
+  Standard output of the command is collected while the command runs and
+  returned once it exits. Nothing is printed here; that is left to the single
+  thread consuming the results (see TargetBuilder.RunTests), so that the workers
+  do nothing but wait on their tests.
 
   Args:
-    stdout_lock: multiprocessing.Lock() object, to guard against standard output
-                 corruption.
-    test_target: The name of the test target.
     command_args: the full command line to run.
-    is_verbose: print subprocess output even on success.
 
   Returns:
     Tuple: (return code, standard output text).
   """
-  try:
-    proc = subprocess.Popen(command_args, stdout=subprocess.PIPE,
-                            stderr=subprocess.STDOUT)
-    stdout, _ = proc.communicate()
-    retcode = proc.wait()
-    stdout_lock.acquire()
-    if retcode or is_verbose:
-      if retcode:
-        sys.stdout.write('{red}FAILED: '.format(red=colorama.Fore.RED))
-      _PrintTestHeader(test_target)
-      print >>sys.stdout, '{reset}{stdout}'.format(
-          reset=colorama.Fore.RESET, stdout=stdout)
-    else:
-      print '{green}PASSED: {reset}{t}'.format(
-          t=test_target, green=colorama.Fore.GREEN, reset=colorama.Fore.RESET)
-    stdout_lock.release()
-  except KeyboardInterrupt:
-    return -1
-  return retcode
-
-
-class _FakeAsyncResult(object):
-  """This is a fake multiprocessing.AsyncResult class.
-
-  This is for use in testing where the platform/tests do not support
-  parallel invocation for whatever reason. To make such cases fit within the
-  multiprocessing.Pool model we are using (see below), we wrap their direct exit
-  codes in this class so they can be used without altering the pattern of the
-  Pool algorithm.
+  # communicate() reads the output in large chunks, rather than splitting it
+  # into lines that are only joined back together.
+  proc = subprocess.Popen(command_args, stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT)
+  stdout, _ = proc.communicate()
+  if not isinstance(stdout, str):
+    # Tests may print anything, so bytes that cannot be decoded are replaced
+    # rather than aborting the whole test run.
+    stdout = stdout.decode(locale.getpreferredencoding(False), 'replace')
+  return proc.returncode, stdout
+
+
+def _PrintTestResult(test_target, retcode, stdout, is_verbose):
+  """Print the outcome of a test run by _AsyncSubprocess.
+
+  The whole report is written at once, rather than piece by piece.
+
+  Args:
+    test_target: The name of the test target.
+    retcode: The return code of the test.
+    stdout: The standard output text of the test.
+    is_verbose: print the test output even on success.
   """
+  if retcode or is_verbose:
+    prefix = _TEST_FAILED_PREFIX if retcode else ''
+    sys.stdout.write(prefix + _TestHeader(test_target) + '\n' +
+                     colorama.Fore.RESET + stdout + '\n')
+  else:
+    sys.stdout.write(_TEST_PASSED_PREFIX + test_target + '\n')
 
-  def __init__(self, retcode):
-    self.retcode = retcode
 
-  # pylint: disable=invalid-name
-  def get(self):
-    return self.retcode
+def _TestHeader(test_target_name):
+  """Returns a unified test header to identify the start of a test.
+
+  Args:
+    test_target_name: The name of the test.
+  """
+  return '{0} {1} {0}'.format('=' * 30, test_target_name)
 
 
 def _PrintTestHeader(test_target_name):
@@ -200,7 +241,7 @@ def _PrintTestHeader(test_target_name):
   Args:
     test_target_name: The name of the test.
   """
-  print '=' * 30, test_target_name, '=' * 30
+  print(_TestHeader(test_target_name))
 
 
 # pylint: disable=invalid-name
@@ -238,23 +279,127 @@ def _FindNearestFiles(anchor, filename_to_find, root_dir=ROOT_DIR):
   """
 
   potential_dir = os.path.dirname(os.path.normpath(anchor)).split(os.sep)
+  probed_keys = []
+  found_file = None
   while potential_dir:
+    key = (os.sep.join(potential_dir), filename_to_find, root_dir)
+    if key in _NEAREST_FILE_CACHE:
+      found_file = _NEAREST_FILE_CACHE[key]
+      break
+    probed_keys.append(key)
+
     potential_file = os.path.join(root_dir,
                                   os.path.join(*potential_dir),
                                   filename_to_find)
-    if os.path.isfile(potential_file):
-      return potential_file
+    if _IsFile(potential_file):
+      found_file = potential_file
+      break
     else:
       potential_dir.pop()
 
-  # No file found.
-  return None
+  # The directories probed on the way up all share the same nearest file (or
+  # lack thereof).
+  for key in probed_keys:
+    _NEAREST_FILE_CACHE[key] = found_file
+  return found_file
+
+
+def _LoadGypi(path):
+  """Returns the dict a gypi file evaluates to.
+
+  Gypi files are plain python literals, so they are parsed with
+  ast.literal_eval rather than executed. Each file is only read and parsed once
+  per invocation. The returned dict is shared by all callers, so it must not be
+  modified.
+
+  Args:
+    path: The path to the gypi file.
+
+  Raises:
+    Error: the gypi file is not a plain python literal.
+
+  Returns:
+    The contents of the gypi file.
+  """
+  if path in _GYPI_CACHE:
+    return _GYPI_CACHE[path]
+
+  with open(path, 'r') as gypi:
+    try:
+      root_dict = ast.literal_eval(gypi.read())
+    except (SyntaxError, ValueError) as err:
+      raise Error('{0} is not a plain gypi literal: {1}'.format(path, err))
+
+  _GYPI_CACHE[path] = root_dict
+  return root_dict
+
+
+def _EvalGypPredicate(predicate, gyp_globals):
+  """Evaluates the predicate of a gypi condition, e.g. 'OS=="linux"'.
+
+  Each predicate is only compiled once per invocation, however many times it is
+  evaluated.
+
+  Args:
+    predicate: The source of the predicate.
+    gyp_globals: The gyp variables the predicate may refer to.
+
+  Returns:
+    The value of the predicate.
+  """
+  code = _PREDICATE_CODE_CACHE.get(predicate)
+  if code is None:
+    code = compile(predicate, '<gypi>', 'eval')
+    _PREDICATE_CODE_CACHE[predicate] = code
+  return eval(code, gyp_globals)
+
+
+def _BuildFlagDefault(value):
+  """Returns the command-line default for a build flag's gypi value.
+
+  Default values that can be converted to integers are treated as such and
+  other values (strings) are left as strings. Initially, all values were
+  converted to integers but this would cause an exception if a non-int string
+  was used as a default.
+
+  Args:
+    value: The value of the variable in the gypi file.
+
+  Returns:
+    The value as an int if possible, otherwise unchanged.
+  """
+  try:
+    return int(value)
+  except (TypeError, ValueError):
+    return value
+
+
+def _IsFile(path):
+  """Returns whether path is a regular file, using a single stat(2) call."""
+  try:
+    return stat.S_ISREG(os.stat(path).st_mode)
+  except OSError:
+    return False
+
+
+def _AvailableCpus():
+  """Returns the number of CPUs this process may actually run on.
+
+  This can be less than multiprocessing.cpu_count() when the process is
+  restricted to a subset of the CPUs, e.g. in a container with a cpuset.
+  """
+  try:
+    return len(os.sched_getaffinity(0))
+  except AttributeError:
+    # os.sched_getaffinity is not available on all platforms.
+    return multiprocessing.cpu_count()
 
 
 def _SmartDeleteDirectory(path):
   """Delete a directory, or a symlink to a directory.
 
-  Deleting a symlink to a directory requires extra effort than usual.
+  Deleting a symlink to a directory requires extra effort than usual. Anything
+  else, including a path that does not exist, is left alone.
 
   Args:
     path: The directory to delete, or a symlink to a directory to delete. In the
@@ -262,13 +407,26 @@ def _SmartDeleteDirectory(path):
           deleted.
   """
 
-  if os.path.isdir(path) and not os.path.islink(path):
+  # A single lstat(2) tells us both whether path is a symlink and, if not,
+  # whether it is a directory. Where the platform supports it, shutil.rmtree
+  # deletes each entry relative to an open descriptor of its parent directory,
+  # so no full path has to be built and resolved per entry. Otherwise, python 3
+  # shutil.rmtree walks each directory with os.scandir, whose entries already
+  # know their type, so there is no stat per entry either.
+  try:
+    mode = os.lstat(path).st_mode
+  except OSError:
+    return
+  if stat.S_ISDIR(mode):
     shutil.rmtree(path)
-  elif os.path.islink(path):
-    target = os.readlink(path)
+  elif stat.S_ISLNK(mode):
+    # Relative links are relative to the directory containing the link, not to
+    # the current directory.
+    target = os.path.join(os.path.dirname(path), os.readlink(path))
 
-    shutil.rmtree(target)
-    os.unlink(path)
+    if os.path.isdir(target):
+      shutil.rmtree(target)
+      os.unlink(path)
 
 
 class Error(Exception):
@@ -296,17 +454,32 @@ class WorkingDirectory(object):
 
 
 class EnvironmentVariables(object):
-  """Context manager for changing the current environment variables."""
+  """Context manager for changing the current environment variables.
+
+  Only the variables that differ are updated, in place, so os.environ remains
+  the same object and the changes are seen by child processes as well.
+  """
 
   def __init__(self, environ):
     self.new_environ = environ
 
   def __enter__(self):
-    self.old_environ = os.environ
-    os.environ = self.new_environ
+    old_environ = os.environ
+    new_environ = self.new_environ
+    # Variables to unset on exit, and previous values to restore on exit.
+    self.added = [k for k in new_environ if k not in old_environ]
+    self.changed = dict((k, v) for k, v in old_environ.items()
+                        if new_environ.get(k) != v)
+    for k in self.changed:
+      if k not in new_environ:
+        del old_environ[k]
+    old_environ.update((k, v) for k, v in new_environ.items()
+                       if old_environ.get(k) != v)
 
   def __exit__(self, etype, value, traceback):
-    os.environ = self.old_environ
+    for k in self.added:
+      os.environ.pop(k, None)
+    os.environ.update(self.changed)
 
 
 class TargetBuilder(object):
@@ -342,9 +515,24 @@ class TargetBuilder(object):
   # straight forward.
   GYP_OUT_SUBDIR = None
 
-  # The number of processes in the multiprocessing.Pool that will be used to
-  # execute tests, if possible for the given platform.
-  TEST_RUNNER_POOL_SIZE = multiprocessing.cpu_count()
+  # The number of CPUs available to run tests, if possible for the given
+  # platform. The executor that runs them uses up to twice as many workers (see
+  # RunTests).
+  TEST_RUNNER_POOL_SIZE = _AvailableCpus()
+
+  # Whether the built tests can be run at all. If not, RunTests() only lists the
+  # tests it skips.
+  CAN_RUN_TESTS = True
+
+  # Whether RunAllConfigurations() can build several configurations at once.
+  # This holds for ninja, which builds each configuration in its own directory,
+  # but not for build tools that share a single project between them.
+  CAN_BUILD_CONFIGURATIONS_IN_PARALLEL = True
+
+  # The (TARGET_OS, TARGET_FLAVOR, GYP_GENERATOR) tuple of a registered builder,
+  # i.e. the key of its configurations in BuildState. Subclasses must not set
+  # this; it is set by the @RegisterBuilder decorator.
+  CONFIGURATIONS_KEY = None
 
   @classmethod
   def NinjaForHost(cls, host_os):
@@ -356,12 +544,7 @@ class TargetBuilder(object):
     Returns:
       Full path to ninja binary.
     """
-    mapping = {
-        'linux': NINJA_LINUX_BINARY_PATH,
-        'mac': NINJA_MAC_BINARY_PATH,
-        'win': NINJA_WINDOWS_BINARY_PATH,
-    }
-    return mapping[host_os]
+    return NINJA_BINARY_PATHS[host_os]
 
   def __init__(self, state):
     self.cmdflags = state.GetCommandLineOptions()
@@ -369,10 +552,17 @@ class TargetBuilder(object):
     self.variables.update(state.GetAdditionalGypVariables())
     self.state = state
     self.host_os = state.host_os
-    # The dummy module uses threads behind the scenes instead of processes. This
-    # results in more stable runs, as there are some signal handling issues
-    # (KeyboardInterrupt) that come into play with processes.
-    self.pool = multiprocessing.dummy.Pool(processes=self.TEST_RUNNER_POOL_SIZE)
+    # Neither of these can change during the lifetime of the builder, so they
+    # are computed on first use and cached.
+    self._build_output_root_dir = None
+    self._build_binary_path = None
+    # Snapshot of the environment the script was started with, which GypEnv and
+    # BuildEnv build upon. Copying a plain dict is much cheaper than copying
+    # os.environ.
+    self._base_env = os.environ.copy()
+    # The executor that RunTest() submits tests to. It only exists while
+    # RunTests() is running.
+    self.pool = None
 
   def GypGenerator(self):
     """Returns the generator this builder will pass to gyp."""
@@ -482,14 +672,12 @@ class TargetBuilder(object):
   def GypEnv(self):
     """Returns the environment variables to use when running gyp.
 
-    By default, this just returns a copy of os.environ.
+    By default, this returns a copy of os.environ with GYP_CROSSCOMPILE set.
 
     Returns:
       A dictionary of environment variables.
     """
-    env = os.environ.copy()
-    env['GYP_CROSSCOMPILE'] = '1'
-    return env
+    return dict(self._base_env, GYP_CROSSCOMPILE='1')
 
   def CanBuildOnHost(self):
     """Returns whether this builder can build on the current host OS."""
@@ -517,7 +705,10 @@ class TargetBuilder(object):
     Returns:
       An absolute path to the build output root directory.
     """
-    return os.path.join(GYP_OUT_DIR, self.GYP_OUT_SUBDIR)
+    if self._build_output_root_dir is None:
+      self._build_output_root_dir = os.path.join(GYP_OUT_DIR,
+                                                 self.GYP_OUT_SUBDIR)
+    return self._build_output_root_dir
 
   def BuildOutputDir(self, configuration):
     """Returns the path to where build output should go for this configuration.
@@ -546,7 +737,7 @@ class TargetBuilder(object):
     Returns:
       A dictionary of environment variables.
     """
-    return os.environ.copy()
+    return self._base_env.copy()
 
   def BuildBinaryPath(self):
     """Returns the path to the build tool for this builder.
@@ -560,9 +751,11 @@ class TargetBuilder(object):
     # Default to ninja binary. Subclasses can override.
 
     # implementations in TargetBuilder with NotImplementedErrors.
-    return self.NinjaForHost(self.host_os)
+    if self._build_binary_path is None:
+      self._build_binary_path = self.NinjaForHost(self.host_os)
+    return self._build_binary_path
 
-  def BuildArgs(self, configuration, unused_filename):
+  def BuildArgs(self, configuration, unused_filename, jobs=None):
     """Return the arguments this builder should pass to the build tool.
 
     By default, this specifies arguments relevant to ninja.  Subclasses using
@@ -571,17 +764,19 @@ class TargetBuilder(object):
     Args:
       configuration: The configuration we're interested in building.
       unused_filename: the .gyp file we ran gyp with.
+      jobs: The number of jobs the build tool should run at once, or None for
+          --threads if it was passed, and one per CPU otherwise.
 
     Returns:
       A list of arguments to pass to the build tool.
     """
 
     # Default to ninja build arguments. Subclasses can override.
-    build_args = []
-    if self.cmdflags.threads is not None:
-      build_args += ['-j', str(self.cmdflags.threads)]
-    else:
-      build_args += ['-j', str(multiprocessing.cpu_count())]
+    if jobs is None:
+      jobs = self.cmdflags.threads
+    if jobs is None:
+      jobs = _AvailableCpus()
+    build_args = ['-j', str(jobs)]
 
     build_args += ['-C', self.BuildOutputDir(configuration)]
     if self.cmdflags.keep_going:
@@ -597,8 +792,7 @@ class TargetBuilder(object):
     gyp-out/$OS directory is deleted.
     """
     PrintStatus('Removing '+ self.BuildOutputRootDir())
-    if os.path.isdir(self.BuildOutputRootDir()):
-      _SmartDeleteDirectory(self.BuildOutputRootDir())
+    _SmartDeleteDirectory(self.BuildOutputRootDir())
 
   def CleanGeneratorDirectory(self):
     """Delete the generator files directory (makefiles, xcode projects, etc).
@@ -627,7 +821,7 @@ class TargetBuilder(object):
     Returns:
       Absolute path to the target (or bundle) on disk.
     """
-    target_name = target.split(':')[-1]
+    target_name = target.rpartition(':')[2]
     path = os.path.join(
         self.BuildOutputDir(configuration), 'tests', target_name)
 
@@ -648,12 +842,12 @@ class TargetBuilder(object):
 
     gyp_generator = self.GypGenerator()
 
-    for k, v in self.GypDefines().iteritems():
-      gyp_args['-D'].append('{k}={v}'.format(k=k, v=v))
-
-    for k, v in self.GypVariables().iteritems():
-      gyp_args['-D'].append('{k}={v}'.format(k=k, v=v))
-
+    # For testability, we really want our -D's in a well-known order that won't
+    # change unpredictably, so let's sort the list.
+    defines = itertools.chain(self.GypDefines().items(),
+                              self.GypVariables().items())
+    gyp_args['-D'] = sorted(itertools.chain(
+        gyp_args['-D'], ('{0}={1}'.format(k, v) for k, v in defines)))
 
     # separate builder for this.
     if self.cmdflags.gypd:
@@ -662,10 +856,6 @@ class TargetBuilder(object):
     if gyp_generator:
       gyp_args['-f'] = gyp_generator
 
-    # For testability, we really want our -D's in a well-known order that won't
-    # change unpredictably, so let's sort the list.
-    gyp_args['-D'].sort()
-
     return gyp_args
 
   @classmethod
@@ -685,32 +875,29 @@ class TargetBuilder(object):
     Returns:
       A list of command-line arguments to gyp.
     """
-    def FormatArgAndValue(arg, value):
-      if arg.startswith('--'):
-        return ['{arg}={value}'.format(arg=arg, value=value)]
-      else:
-        return [arg, value]
-
     command_line = []
-    for k, v in flags.iteritems():
-      if isinstance(v, basestring):
-        # Just add the key and value.
-        command_line += FormatArgAndValue(k, v)
-      elif v is None:
+    for k, v in flags.items():
+      if v is None:
         # Argument takes no value.
         command_line.append(k)
+      elif k.startswith('--'):
+        if isinstance(v, str):
+          command_line.append(k + '=' + v)
+        else:
+          # Add the key once with each value.
+          prefix = k + '='
+          command_line.extend(prefix + x for x in v)
+      elif isinstance(v, str):
+        command_line.extend((k, v))
       else:
-        # Add the key multiple times, once with each value, as a flat list.
-        command_line += list(
-            itertools.chain.from_iterable([FormatArgAndValue(k, x) for x in v]))
+        for x in v:
+          command_line.extend((k, x))
 
     # Newer versions of gyp complain if there are multiple source files with the
     # same filename in the same gyp files (even if they are in different targets
     # or directories). Unfortunately Ion and Ion-dependent projects have many
     # such cases, so we currently need to ignore this warning.
-    command_line.append('--no-duplicate-basename-check')
-
-    command_line.append(filename)
+    command_line.extend(('--no-duplicate-basename-check', filename))
 
     return command_line
 
@@ -744,7 +931,7 @@ class TargetBuilder(object):
     gyp_env = self.GypEnv()
     gyp_cwd = self.GypCWD()
 
-    print 'gyp {0}'.format(' '.join(gyp_args))
+    print('gyp {0}'.format(' '.join(gyp_args)))
 
     with WorkingDirectory(gyp_cwd):
       with EnvironmentVariables(gyp_env):
@@ -752,7 +939,7 @@ class TargetBuilder(object):
 
     return ret
 
-  def RunBuild(self, configuration, filename):
+  def RunBuild(self, configuration, filename, jobs=None):
     """Runs the OS specific build tool, e.g. xcodebuild, ninja, etc.
 
     Determines the following variables based on host_os/target_os:
@@ -762,6 +949,7 @@ class TargetBuilder(object):
     Args:
       configuration: The gyp configuration to build.
       filename:      gyp filename whose output is to be built.
+      jobs:          The number of jobs to run at once. See BuildArgs().
 
     Raises:
       InvalidTargetOSError: Can't build target OS on this host.
@@ -774,14 +962,62 @@ class TargetBuilder(object):
 
     build_env = self.BuildEnv(configuration)
     build_cwd = self.BuildCWD()
-    build_args = self.BuildArgs(configuration, filename)
+    build_args = self.BuildArgs(configuration, filename, jobs)
     build_binary_path = self.BuildBinaryPath()
 
     # Invoke build tool
     call_list = [build_binary_path] + build_args
-    print ' '.join(call_list)
+    # The build tool writes straight to our stdout, so flush the command line
+    # before starting it. Otherwise, when stdout is a pipe, the command line
+    # would only show up after the build's output.
+    sys.stdout.write(' '.join(call_list) + '\n')
+    sys.stdout.flush()
     return subprocess.call(call_list, cwd=build_cwd, env=build_env)
 
+  def RunAllConfigurations(self, configurations, filename):
+    """Runs RunBuild() for several configurations.
+
+    The configurations are built by independent invocations of the build tool,
+    which the script only waits on, so if the builder allows it (see
+    CAN_BUILD_CONFIGURATIONS_IN_PARALLEL) they are run from a thread pool.
+    Otherwise they are built one after another, stopping at the first failure
+    unless --keep-going was passed.
+
+    Args:
+      configurations: The gyp configurations to build.
+      filename:       gyp filename whose output is to be built.
+
+    Returns:
+      0 if all builds succeeded, otherwise the return code of a failed build.
+    """
+    if len(configurations) == 1:
+      return self.RunBuild(configurations[0], filename)
+
+    retcode = 0
+    if not self.CAN_BUILD_CONFIGURATIONS_IN_PARALLEL:
+      for configuration in configurations:
+        exitcode = self.RunBuild(configuration, filename)
+        if exitcode:
+          retcode = retcode or exitcode
+          if not self.cmdflags.keep_going:
+            break
+      return retcode
+
+    # Unless --threads was passed, the CPUs are divided among the builds, so
+    # that they are not oversubscribed.
+    jobs = None
+    if self.cmdflags.threads is None:
+      jobs = max(1, _AvailableCpus() // len(configurations))
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=len(configurations)) as executor:
+      futures = [executor.submit(self.RunBuild, configuration, filename, jobs)
+                 for configuration in configurations]
+      for future in concurrent.futures.as_completed(futures):
+        exitcode = future.result()
+        if exitcode and not retcode:
+          retcode = exitcode
+    return retcode
+
   def RunTest(self, configuration, test_target, test_args):
     """Given a configuration, test name, and test arguments, run the test.
 
@@ -798,17 +1034,43 @@ class TargetBuilder(object):
       test_args: list of command line arguments for test, or None.
 
     Returns:
-      The multiprocessing.AsyncResult object of the process. Use .get() on this
-      to get the return code of the binary.
+      The concurrent.futures.Future object of the process. Use .result() on
+      this to get the return code of the binary.
     """
     command_args = [self.PathToBuiltTest(configuration, test_target)]
     if test_args:
       command_args.extend(test_args)
 
-    async_result = self.pool.apply_async(
-        _AsyncSubprocess, args=(self.stdout_lock, test_target, command_args,
-                                self.cmdflags.verbose))
-    return async_result
+    return self.pool.submit(_AsyncSubprocess, command_args)
+
+  def _FindTestTargets(self, filename):
+    """Returns the unittest targets (those ending in "_test") of a gypfile.
+
+    Finding them requires running gyp to dump the dependency graph, so the
+    result is cached in the BuildState and reused by later calls for the same
+    gypfile, target OS and flavor.
+
+    Args:
+      filename: path (relative to ROOT_DIR, or absolute) to a .gyp file.
+
+    Returns:
+      A frozenset of test targets, e.g. 'port/tests/port_test.gyp:port_test'.
+    """
+    cache = self.state.GetTestTargetsCache()
+    key = (os.path.normpath(os.path.join(ROOT_DIR, filename)), self.TARGET_OS,
+           self.TARGET_FLAVOR)
+    if key not in cache:
+      dump_dependency_json = self.state.GetDumpDependencyBuilder(
+          self.TARGET_OS, self.TARGET_FLAVOR)
+      dependency_dump = dump_dependency_json.GetDependencyJson(filename)
+
+      # Keep only the targets that end in '_test' (the unittests), and remove
+      # their trailing '#target'. Filtering first means that only the targets
+      # we keep are ever split.
+      cache[key] = frozenset(
+          t.split('#target', 1)[0] for t in dependency_dump
+          if t.endswith(('_test', '_test#target')))
+    return cache[key]
 
   def GlobalTestSetup(self):
     """Conduct any setup necessary for running tests.
@@ -827,10 +1089,11 @@ class TargetBuilder(object):
     The actual test binaries will have to be found on disk, depending on the
     build method.
 
-    This method tries to use a multiprocessing.Pool() to run the tests in
-    parallel (unless stop_on_failure is given, in which case everything is run
-    serially). It prevents interleved stdout by supplying a Lock() object to the
-    test processes.
+    This method tries to use a concurrent.futures executor to run the tests in
+    parallel. If stop_on_failure is given, the tests that have not started yet
+    are cancelled as soon as one fails. The test workers only run the tests;
+    their output is reported by this thread alone as each test completes, so
+    stdout is never interleaved.
 
     Args:
       configuration: the build configuration whose built test we want to run.
@@ -845,65 +1108,101 @@ class TargetBuilder(object):
       Bitwise-OR of all return codes of tests.
     """
 
-    dump_dependency_json = DumpDependencyBuilder(
-        self.state, target_os=self.TARGET_OS, target_flavor=self.TARGET_FLAVOR)
-    dependency_dump = dump_dependency_json.GetDependencyJson(filename)
+    test_targets = self._FindTestTargets(filename)
 
-    targets = dependency_dump.keys()
-
-    # Remove the trailing '#target' from all targets.
-    targets = [t.split('#target')[0] for t in targets]
-
-    # Remove targets that don't end in '_test', leaving only the unittests.
-    test_targets = set([t for t in targets if t.endswith('_test')])
+    if not self.CAN_RUN_TESTS:
+      for test_target in test_targets:
+        _PrintTestHeader(test_target)
+        print('No way to run test, skipping', test_target)
+      return 0
 
     # Conduct any one-time global test setup before running the tests.
     self.GlobalTestSetup()
 
     PrintStatus('Running {0} test targets.'.format(len(test_targets)))
 
-    self.stdout_lock = multiprocessing.dummy.Lock()
+    # The test workers spend nearly all of their time blocked on their test's
+    # output, and report nothing themselves, so threads are enough; worker
+    # processes would only add fork and pickling costs. Since the workers mostly
+    # wait, allow twice as many as there are CPUs, so that the tests themselves
+    # keep every CPU busy without so many running at once that they thrash the
+    # scheduler and each other's caches. There is no point in having more
+    # workers than tests either.
+    pool_size = max(1, min(len(test_targets), 2 * self.TEST_RUNNER_POOL_SIZE))
+
+    # Leaving this block waits for any tests that are still running, including
+    # when returning early on failure.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=pool_size) as pool:
+      self.pool = pool
+      try:
+        return self._RunTestsInPool(configuration, test_targets, test_args,
+                                    stop_on_failure)
+      finally:
+        self.pool = None
+
+  def _RunTestsInPool(self, configuration, test_targets, test_args,
+                      stop_on_failure):
+    """Run the given tests using self.pool, reporting them as they complete.
 
-    results = []
+    Args:
+      configuration: the build configuration whose built test we want to run.
+      test_targets: the test targets to run.
+      test_args: optional list of command line arguments for test.
+      stop_on_failure: if True, cancel the tests that have not started yet and
+          return as soon as one fails.
+
+    Returns:
+      If stop_on_failure: the return code of the first failing tests. Otherwise,
+      Bitwise-OR of all return codes of tests.
+    """
+    future_to_target = {}
+    retcode_cumulative = 0
     for test_target in test_targets:
       result = self.RunTest(configuration, test_target, test_args)
 
-      # result can be an AsyncResult object, or an exit code (integer) if the
-      # RunTest method couldn't be parallelized. If the latter, wrap it in a
-      # _FakeAsyncResult() so it can be handled seemlessly below.
+      # result can be a Future object, or an exit code (integer) if the
+      # RunTest method couldn't be parallelized. If the latter, the test has
+      # already run and printed its own output.
       if isinstance(result, int):
-        result = _FakeAsyncResult(result)
-
-      results.append((test_target, result))
-
-      if stop_on_failure:
-        # We can't be too parallel here, since the user requested
-        # stop_on_failure. Instead, force synchronous behavior by waiting on
-        # the result object.
-        retcode = result.get()
-        if retcode:
-          # Do not change the string below! It is used in test result filtering
-          # by pulse.
-          print 'TEST RETURNED NON-ZERO:', test_target
-          return retcode
-
-    # Wait for everything to finish.
-    self.pool.close()
-    self.pool.join()
-
-    retcode_cumulative = 0
-    for test_target, result in results:
-      # This will raise an exception if there was an exception in the async
-      # process, which is the behavior what we want.
-      retcode = result.get()
-      if retcode:
-        # Do not change the string below! It is used in test result filtering
-        # by pulse.
-        print 'TEST RETURNED NON-ZERO:', test_target
+        self._ReportTestResult(test_target, result)
+        if result and stop_on_failure:
+          for pending_future in future_to_target:
+            pending_future.cancel()
+          return result
+        retcode_cumulative |= result
+      else:
+        future_to_target[result] = test_target
+
+    # Report the tests in the order they finish, rather than the order they
+    # were started, so that a slow test does not hold back the others.
+    for future in concurrent.futures.as_completed(future_to_target):
+      # This will raise an exception if there was an exception in the test
+      # worker, which is the behavior we want.
+      retcode, stdout = future.result()
+      self._ReportTestResult(future_to_target[future], retcode, stdout)
+      if retcode and stop_on_failure:
+        for pending_future in future_to_target:
+          pending_future.cancel()
+        return retcode
       retcode_cumulative |= retcode
 
     return retcode_cumulative
 
+  def _ReportTestResult(self, test_target, retcode, stdout=None):
+    """Print the outcome of a test.
+
+    Args:
+      test_target: the name of the test target.
+      retcode: the return code of the test.
+      stdout: the output of the test, or None if it was already printed.
+    """
+    if stdout is not None:
+      _PrintTestResult(test_target, retcode, stdout, self.cmdflags.verbose)
+    if retcode:
+      # Do not change the string below! It is used in test result filtering
+      # by pulse.
+      print('TEST RETURNED NON-ZERO:', test_target)
+
 
 # A registry mapping environments to builders. Keys are tuples:
 #   (<target_os>, <gyp_generator>)
@@ -927,7 +1226,7 @@ def RegisterBuilder(builder_class):
     builder_class: The concrete class to register.
 
   Returns:
-    The class (unmodified).
+    The class, with its CONFIGURATIONS_KEY set.
 
   Raises:
     Error: if the builder being registered does not define TARGET_OS.
@@ -942,6 +1241,11 @@ def RegisterBuilder(builder_class):
 
   key = (builder_os, builder_class.GYP_GENERATOR)
   BUILDER_REGISTRY[key] = builder_class
+  # Snapshot the attributes, so that scanning the registry does not have to look
+  # each of them up through the class hierarchy.
+  builder_class.CONFIGURATIONS_KEY = (builder_class.TARGET_OS,
+                                      builder_class.TARGET_FLAVOR,
+                                      builder_class.GYP_GENERATOR)
   return builder_class
 
 
@@ -996,8 +1300,8 @@ class ASMJSBuilder(TargetBuilder):
       test_args: list of command line arguments for test, or None.
 
     Returns:
-      The multiprocessing.AsyncResult object of the process. Use .get() on this
-      to get the return code of the binary.
+      The concurrent.futures.Future object of the process. Use .result() on
+      this to get the return code of the binary.
     """
     test_path = self.PathToBuiltTest(configuration, test_target)
 
@@ -1006,11 +1310,8 @@ class ASMJSBuilder(TargetBuilder):
     if test_args:
       command_args.append('--')
       command_args.extend(test_args)
-    print ' '.join(command_args)
-    async_result = self.pool.apply_async(
-        _AsyncSubprocess, args=(self.stdout_lock, test_target, command_args,
-                                self.cmdflags.verbose))
-    return async_result
+    print(' '.join(command_args))
+    return self.pool.submit(_AsyncSubprocess, command_args)
 
 
 @RegisterBuilder
@@ -1031,8 +1332,8 @@ class NACLBuilder(TargetBuilder):
       test_args: list of command line arguments for test, or None.
 
     Returns:
-      The AsyncResult object of the process. Use .get() on this to get the
-      return code of the binary.
+      The concurrent.futures.Future object of the process. Use .result() on
+      this to get the return code of the binary.
     """
     test_path = self.PathToBuiltTest(configuration, test_target)
     command_args = [sys.executable]
@@ -1043,10 +1344,7 @@ class NACLBuilder(TargetBuilder):
       command_args.append('--')
       command_args.extend(test_args)
 
-    async_result = self.pool.apply_async(
-        _AsyncSubprocess, args=(self.stdout_lock, test_target, command_args,
-                                self.cmdflags.verbose))
-    return async_result
+    return self.pool.submit(_AsyncSubprocess, command_args)
 
 
 @RegisterBuilder
@@ -1057,11 +1355,8 @@ class PNACLBuilder(NACLBuilder):
   GYP_GENERATOR = 'ninja'
   GYP_OUT_SUBDIR = 'nacl-pnacl'
 
-  def RunTest(self, unused_configuration, test_target, unused_test_args):
-    _PrintTestHeader(test_target)
-    # No way to run pnacl binaries (yet).
-    print 'No way to run test, skipping', test_target
-    return 0
+  # No way to run pnacl binaries (yet).
+  CAN_RUN_TESTS = False
 
 
 @RegisterBuilder
@@ -1104,14 +1399,8 @@ class AndroidX86Builder(AndroidBuilder):
 class AndroidBuilderNoEmu(AndroidBuilder):
   """A unregistered builder base class that disables emulator testing."""
 
-  def GlobalTestSetup(self):
-    pass
-
-  def RunTest(self, unused_configuration, test_target, unused_test_args):
-    _PrintTestHeader(test_target)
-    # No way to run these binaries for this android (no emulator support).
-    print 'No way to run test, skipping', test_target
-    return 0
+  # No way to run these binaries for this android (no emulator support).
+  CAN_RUN_TESTS = False
 
 
 @RegisterBuilder
@@ -1185,8 +1474,7 @@ class MacHybridBuilder(MacNinjaBuilder):
   def CleanGeneratorDirectory(self):
     """Delete the generator files directory (xcode projects)."""
     PrintStatus('Removing ' + GYP_PROJECTS_DIR)
-    if os.path.isdir(GYP_PROJECTS_DIR):
-      _SmartDeleteDirectory(GYP_PROJECTS_DIR)
+    _SmartDeleteDirectory(GYP_PROJECTS_DIR)
 
 
 @RegisterBuilder
@@ -1210,6 +1498,15 @@ class MacBuilder(TargetBuilder):
   GYP_GENERATOR = 'xcode'
   GYP_OUT_SUBDIR = 'mac-xcode'
 
+  # Every configuration is built from the same xcode project.
+  CAN_BUILD_CONFIGURATIONS_IN_PARALLEL = False
+
+  def __init__(self, state):
+    super(MacBuilder, self).__init__(state)
+    # Maps configurations to the directories their tests are built in. See
+    # _BuiltTestsDir().
+    self._built_tests_dirs = {}
+
   def GypArgs(self):
     generator_output_dir = GYP_PROJECTS_DIR
 
@@ -1224,7 +1521,7 @@ class MacBuilder(TargetBuilder):
   def BuildBinaryPath(self):
     return '/usr/bin/xcodebuild'
 
-  def BuildArgs(self, configuration, filename):
+  def BuildArgs(self, configuration, filename, jobs=None):
     build_args = []
 
     if self.cmdflags.keep_going:
@@ -1232,9 +1529,11 @@ class MacBuilder(TargetBuilder):
     if self.cmdflags.verbose:
       build_args.append('-verbose')
 
-    if self.cmdflags.threads is not None:
+    if jobs is None:
+      jobs = self.cmdflags.threads
+    if jobs is not None:
       # If --threads is not specified, let xcodebuild figure it out itself.
-      build_args.append('-jobs={t}'.format(t=self.cmdflags.threads))
+      build_args.append('-jobs={t}'.format(t=jobs))
 
     build_args += ['-configuration', configuration]
     project_name, _ = os.path.splitext(filename)
@@ -1253,17 +1552,36 @@ class MacBuilder(TargetBuilder):
     Returns:
       Absolute path to the target on disk.
     """
-    target_name = target.split(':')[-1]
-    path = os.path.join(
-        self.BuildOutputRootDir(), configuration, 'obj', configuration,
-        target_name)
-    return path
+    target_name = target.rpartition(':')[2]
+    return os.path.join(self._BuiltTestsDir(configuration), target_name)
+
+  def _BuiltTestsDir(self, configuration):
+    """Returns the directory the tests of a configuration are built in.
+
+    The result is cached, since it is the same for all the tests of a
+    configuration.
+
+    Args:
+      configuration: the build configuration whose built test we want to run.
+
+    Returns:
+      Absolute path to the directory.
+    """
+    tests_dir = self._built_tests_dirs.get(configuration)
+    if tests_dir is None:
+      tests_dir = os.path.join(self.BuildOutputRootDir(), configuration, 'obj',
+                               self._ProductsDirName(configuration))
+      self._built_tests_dirs[configuration] = tests_dir
+    return tests_dir
+
+  def _ProductsDirName(self, configuration):
+    """Returns the name of the xcode products directory for configuration."""
+    return configuration
 
   def CleanGeneratorDirectory(self):
     """Delete the generator files directory (xcode projects)."""
     PrintStatus('Removing ' + GYP_PROJECTS_DIR)
-    if os.path.isdir(GYP_PROJECTS_DIR):
-      _SmartDeleteDirectory(GYP_PROJECTS_DIR)
+    _SmartDeleteDirectory(GYP_PROJECTS_DIR)
 
 
 @RegisterBuilder
@@ -1275,9 +1593,9 @@ class IOSBuilder(MacBuilder):
 
   SDK = 'iphoneos'
 
-  def BuildArgs(self, configuration, filename):
+  def BuildArgs(self, configuration, filename, jobs=None):
     build_args = super(IOSBuilder, self).BuildArgs(
-        configuration, filename)
+        configuration, filename, jobs)
 
     build_args.extend(['-sdk', self.SDK])
     return build_args
@@ -1293,11 +1611,12 @@ class IOSBuilder(MacBuilder):
     Returns:
       Absolute path to the bundle on disk.
     """
-    target_name = target.split(':')[-1]
-    path = os.path.join(
-        self.BuildOutputRootDir(), configuration, 'obj',
-        configuration + '-' + self.SDK, target_name + '.app')
-    return path
+    target_name = target.rpartition(':')[2]
+    return os.path.join(self._BuiltTestsDir(configuration),
+                        target_name + '.app')
+
+  def _ProductsDirName(self, configuration):
+    return configuration + '-' + self.SDK
 
 
 @RegisterBuilder
@@ -1329,7 +1648,7 @@ class IOSNinjaBuilder(MacNinjaBuilder):
     Returns:
       Absolute path to the bundle on disk.
     """
-    target_name = target.split(':')[-1]
+    target_name = target.rpartition(':')[2]
     path = os.path.join(
         self.BuildOutputRootDir(), configuration, target_name + '.app')
     return path
@@ -1429,31 +1748,34 @@ class WindowsBuilderMSVS(TargetBuilder):
   GYP_GENERATOR = 'msvs'
   GYP_OUT_SUBDIR = 'win-msvs'
 
+  # Nothing is built here; RunBuild() only points to the solution file.
+  CAN_BUILD_CONFIGURATIONS_IN_PARALLEL = False
+
   def GypArgs(self):
     gyp_args = super(WindowsBuilderMSVS, self).GypArgs()
     gyp_args['--generator-output'] = '{d}'.format(d=GYP_PROJECTS_DIR)
     return gyp_args
 
-  def RunBuild(self, unused_configuration, filename):
+  def RunBuild(self, unused_configuration, filename, unused_jobs=None):
     """Point to the solution files for visual studio.
 
     Args:
       unused_configuration: The gyp configuration (unused).
       filename: gyp filename of the target of interested.
+      unused_jobs: The number of jobs to run at once (unused).
     """
-    print 'Open Visual Studio to build:'
-    print
+    print('Open Visual Studio to build:')
+    print()
 
     # Point to the .sln file that we just generated.
     project_name, _ = os.path.splitext(filename)
-    print os.path.join(GYP_PROJECTS_DIR,
-                       '{p}_{o}.sln'.format(p=project_name, o=self.TARGET_OS))
+    print(os.path.join(GYP_PROJECTS_DIR,
+                       '{p}_{o}.sln'.format(p=project_name, o=self.TARGET_OS)))
 
   def CleanGeneratorDirectory(self):
     """Delete the generator files directory (MSVS projects)."""
     PrintStatus('Removing ' + GYP_PROJECTS_DIR)
-    if os.path.isdir(GYP_PROJECTS_DIR):
-      _SmartDeleteDirectory(GYP_PROJECTS_DIR)
+    _SmartDeleteDirectory(GYP_PROJECTS_DIR)
 
 
 # This is not decorated with @RegisterBuilder because it only implements some
@@ -1492,16 +1814,33 @@ class DumpDependencyBuilder(TargetBuilder):
     if not os.path.isdir(self.BuildOutputRootDir()):
       os.makedirs(self.BuildOutputRootDir())
 
-    super(DumpDependencyBuilder, self).RunGyp(filename)
+    return super(DumpDependencyBuilder, self).RunGyp(filename)
 
   def GetDependencyJson(self, filename):
-    self.RunGyp(filename)
+    """Returns the dependency graph of a gypfile.
+
+    gyp runs in this process (see RunGyp), so this costs no more than the gyp
+    run itself and the parse of the dump.json file it writes.
+
+    Args:
+      filename: The name of the gyp file that will be passed to gyp.
+
+    Raises:
+      Error: gyp failed, so there is no up-to-date dump.json to read.
+
+    Returns:
+      The parsed contents of dump.json, a dict mapping each target to the list
+      of targets it depends on.
+    """
+    if self.RunGyp(filename):
+      raise Error('gyp returned non-zero while dumping dependencies')
     json_path = os.path.join(self.BuildOutputRootDir(), 'dump.json')
     if not os.path.exists(json_path):
       json_path = os.path.join(self.GypCWD(), 'dump.json')
-    return json.load(open(json_path, 'r'))
+    with open(json_path, 'r') as dump_json:
+      return json.load(dump_json)
 
-  def RunBuild(self, unused_configuration, unused_filename):
+  def RunBuild(self, unused_configuration, unused_filename, unused_jobs=None):
     """Undefined, do not call."""
     raise NotImplementedError
 
@@ -1511,7 +1850,8 @@ class BuildState(object):
 
   The public interface of BuildState consists solely of accessor methods.
   These all return cached data which is computed when the BuildState object is
-  constructed, so they are very inexpensive to call.
+  constructed (or, for configurations, on first use), so they are very
+  inexpensive to call.
   """
 
   def __init__(self, argv):
@@ -1544,8 +1884,15 @@ class BuildState(object):
         'win': 'win',
     }[self.host_os]
 
+    # Maps builder configuration keys to their configuration names. Filled in
+    # lazily, since a build only needs the configurations of its own builder.
+    self.all_configs_ = {}
+
     self.args_ = self._ParseCommandLineArgs(argv)
 
+    self.test_targets_cache_ = {}
+    self.dump_dependency_builders_ = {}
+
   def GetCommandLineOptions(self):
     """Returns an object with attributes for each command line option.
 
@@ -1584,8 +1931,12 @@ class BuildState(object):
     variables = {}
     args = self.GetCommandLineOptions()
     for k, v in self.GetPossibleBuildFlags().items():
-      if v != getattr(args, k):
-        variables[k] = getattr(args, k)
+      # If nothing on the command line could set a build flag, no option was
+      # added for it (see _ParseCommandLineArgs), and it has the default value
+      # that option would have had.
+      value = getattr(args, k, _BuildFlagDefault(v))
+      if v != value:
+        variables[k] = value
     return variables
 
   def GetAdditionalGypVariables(self):
@@ -1612,6 +1963,35 @@ class BuildState(object):
     """
     return self.GetCommandLineOptions().G
 
+  def GetTestTargetsCache(self):
+    """Returns the dict in which builders cache the test targets they find.
+
+    See TargetBuilder._FindTestTargets for the format of its keys and values.
+
+    Returns:
+      A dictionary shared by all builders using this BuildState.
+    """
+    return self.test_targets_cache_
+
+  def GetDumpDependencyBuilder(self, target_os, target_flavor=''):
+    """Returns a DumpDependencyBuilder for the given target OS and flavor.
+
+    Builders are created on first use and then reused, since constructing one
+    is not free.
+
+    Args:
+      target_os: The target OS whose dependency graph will be dumped.
+      target_flavor: The flavor of target_os, if any.
+
+    Returns:
+      A DumpDependencyBuilder using this BuildState.
+    """
+    key = (target_os, target_flavor)
+    if key not in self.dump_dependency_builders_:
+      self.dump_dependency_builders_[key] = DumpDependencyBuilder(
+          self, target_os=target_os, target_flavor=target_flavor)
+    return self.dump_dependency_builders_[key]
+
   def GetGypFileToRun(self):
     """Returns the gypfile that should be passed to gyp.
 
@@ -1628,8 +2008,8 @@ class BuildState(object):
   def GetConfigurationsForOS(self, target_os, target_flavor='', generator=None):
     """Returns list of gyp configurations available for a target OS and flavor.
 
-    Unlike _FindConfigurationsForOS, this method returns cached data and is
-    very inexpensive.
+    Unlike _FindConfigurationsForOS, this method caches its result, so it is
+    very inexpensive after the first call for each target.
 
     Args:
       target_os: The target OS to get configurations for.
@@ -1639,16 +2019,12 @@ class BuildState(object):
     Returns:
       List of configuration names available for the given arguments.
     """
-    return self.all_configs_[(target_os, target_flavor, generator)]
-
-  @classmethod
-  def _FindAllConfigurations(cls):
-    """Return all the configurations for each builder."""
-    all_configs = {}
-    for builder in BUILDER_REGISTRY.values():
-      key = (builder.TARGET_OS, builder.TARGET_FLAVOR, builder.GYP_GENERATOR)
-      all_configs[key] = cls._FindConfigurationsForOS(*key)
-    return all_configs
+    key = (target_os, target_flavor, generator)
+    configurations = self.all_configs_.get(key)
+    if configurations is None:
+      configurations = self._FindConfigurationsForOS(*key)
+      self.all_configs_[key] = configurations
+    return configurations
 
   @classmethod
   def _FindConfigurationsForOS(cls, target_os, target_flavor='', generator=''):
@@ -1679,53 +2055,54 @@ class BuildState(object):
     if not os.path.isfile(os_gypi_file):
       return []
 
-    with open(os_gypi_file, 'r') as os_gypi:
-      root_dict = eval(os_gypi.read())
-
-      # All other variables/globals are not defined and will cause an evaluation
-      # error if they are seen in os.gypi.
-      gyp_globals = {
-          'OS': target_os,
-          'flavor': target_flavor,
-          'GENERATOR': generator,
-          '__builtins__': None
-      }
+    # os.gypi is the same for every builder, so it is only parsed once (see
+    # _LoadGypi) however many builders' configurations are looked up.
+    root_dict = _LoadGypi(os_gypi_file)
+
+    # All other variables/globals are not defined and will cause an evaluation
+    # error if they are seen in os.gypi.
+    gyp_globals = {
+        'OS': target_os,
+        'flavor': target_flavor,
+        'GENERATOR': generator,
+        '__builtins__': None
+    }
 
-      # Poor man's gyp processing: we are only interested in finding
-      # 'configurations', so parse and process the resulting top-level dict,
-      # descending as needed, and collecting configuration names. The below only
-      # handles 'target_defaults', 'conditions', and 'configurations' sections,
-      # which should suffice.
-      dicts_to_eval = [root_dict]
-      while dicts_to_eval:
-        current_dict = dicts_to_eval.pop(0)
-
-        for k, v in current_dict.items():
-          if k == 'target_defaults':
-            # Although technically the 'configurations' section can also be
-            # found inside a 'targets', we have adopted the convention that they
-            # only appear in our os.gypi file, inside the 'target_defaults'.
-            # Therefore, it is fine to only descend into this section.
-            dicts_to_eval.append(v)
-          elif k == 'conditions':
-            for condition in v:
-              if len(condition) == 2:
-                predicate, true_dict = condition
-                else_dict = {}
-              else:
-                predicate, true_dict, else_dict = condition
-
-              if eval(predicate, gyp_globals):
-                dicts_to_eval.append(true_dict)
-              elif else_dict:
-                dicts_to_eval.append(else_dict)
-          elif k == 'configurations':
-            # Add the configuration names to the list, iff they are not
-            # abstract.
-            configuration_names.extend(conf for conf, values in v.items()
-                                       if not values.get('abstract', False))
-          elif k == 'default_configuration':
-            default_configuration = v
+    # Poor man's gyp processing: we are only interested in finding
+    # 'configurations', so parse and process the resulting top-level dict,
+    # descending as needed, and collecting configuration names. The below only
+    # handles 'target_defaults', 'conditions', and 'configurations' sections,
+    # which should suffice.
+    dicts_to_eval = collections.deque([root_dict])
+    while dicts_to_eval:
+      current_dict = dicts_to_eval.popleft()
+
+      for k, v in current_dict.items():
+        if k == 'target_defaults':
+          # Although technically the 'configurations' section can also be
+          # found inside a 'targets', we have adopted the convention that they
+          # only appear in our os.gypi file, inside the 'target_defaults'.
+          # Therefore, it is fine to only descend into this section.
+          dicts_to_eval.append(v)
+        elif k == 'conditions':
+          for condition in v:
+            if len(condition) == 2:
+              predicate, true_dict = condition
+              else_dict = {}
+            else:
+              predicate, true_dict, else_dict = condition
+
+            if _EvalGypPredicate(predicate, gyp_globals):
+              dicts_to_eval.append(true_dict)
+            elif else_dict:
+              dicts_to_eval.append(else_dict)
+        elif k == 'configurations':
+          # Add the configuration names to the list, iff they are not
+          # abstract.
+          configuration_names.extend(conf for conf, values in v.items()
+                                     if not values.get('abstract', False))
+        elif k == 'default_configuration':
+          default_configuration = v
 
     # The list has no specific ordering thus far, because dicts are unordered.
     # Apply an ordering, just so that the return values are somewhat consistent.
@@ -1762,46 +2139,50 @@ class BuildState(object):
     """
 
     variables = {}
-    files_to_parse = []
+    files_to_parse = collections.deque()
+    # Real paths of the files seen so far. A gypi that is included from several
+    # places (e.g. a shared common.gypi in a diamond of includes) is only walked
+    # once, and include cycles terminate.
+    seen_files = set()
 
     common_variables = _FindNearestFiles(filename, COMMON_VARIABLES)
     if common_variables:
       files_to_parse.append(common_variables)
 
     while files_to_parse:
-      f = files_to_parse.pop(0)
+      f = files_to_parse.popleft()
+      real_path = os.path.realpath(f)
+      if real_path in seen_files:
+        continue
+      seen_files.add(real_path)
       if not os.path.isfile(f):
         continue
-      with open(f, 'r') as gypi:
-        root_dict = eval(gypi.read())
-
-        # Poor man's gyp processing: we are only interested in finding
-        # 'variables'.
-        dicts_to_eval = [root_dict]
-        while dicts_to_eval:
-          current_dict = dicts_to_eval.pop(0)
-
-          for k, v in current_dict.items():
-            if k == 'variables':
-              for i, j in v.items():
-                # Only consider variables with a '%' sign at the end, meaning
-                # that they will take a value from the command line if present,
-                # and also a simple default value (those containing '<' contain
-                # a variable expansion).
-                if i[-1:] == '%' and '<' not in str(j):
-                  variables[i[:-1]] = j
-                elif i == 'variables':
-                  # Parse this 'variables' entry as a dictionary of its own.
-                  dicts_to_eval.append({i: j})
-
-            elif k == 'includes':
-              files_to_parse.extend(
-                  [os.path.join(os.path.dirname(f), include) for include in v])
+      root_dict = _LoadGypi(f)
+
+      # Poor man's gyp processing: we are only interested in finding
+      # 'variables', including those in nested 'variables' scopes.
+      variable_scopes = collections.deque()
+      if 'variables' in root_dict:
+        variable_scopes.append(root_dict['variables'])
+      while variable_scopes:
+        for i, j in variable_scopes.popleft().items():
+          # Only consider variables with a '%' sign at the end, meaning that
+          # they will take a value from the command line if present, and also a
+          # simple default value (those containing '<' contain a variable
+          # expansion).
+          if i[-1:] == '%' and '<' not in str(j):
+            variables[i[:-1]] = j
+          elif i == 'variables':
+            variable_scopes.append(j)
+
+      files_to_parse.extend(
+          [os.path.normpath(os.path.join(os.path.dirname(f), include))
+           for include in root_dict.get('includes', [])])
 
     return variables
 
   @classmethod
-  def _MakeGypFilePath(cls, path_string):
+  def _MakeGypFilePath(cls, path_string, verify=False):
     """Returns a gypfile path from a path-like specification string.
 
     Gyp wants paths to individual gypfiles to build, but that's sometimes
@@ -1819,52 +2200,57 @@ class BuildState(object):
 
     Args:
       path_string: A path-like string describing a gyp file to run.
+      verify: Whether to return None if the gypfile does not exist.
 
     Returns:
       A relative path to the gypfile represented by the path string.  If the
       gypfile is fully specified in path_string but does not exist, returns
-      path_string directly.  If path_string represents a directory not
-      containing a gypfile with the same name, returns None.
+      path_string directly, or None if verify is set.  If path_string represents
+      a directory not containing a gypfile with the same name, returns None.
     """
     if path_string is None:
       return None
 
     # Resolve '//' as a path relative to the root dir, regardless of the current
-    # working directory.
+    # working directory. Other paths are relative to the working directory, so
+    # they cannot be used as they are; relpath makes them absolute first.
     if path_string.startswith('//'):
       path_string = path_string[2:]
     else:
-      path_string = os.path.relpath(os.path.abspath(path_string), ROOT_DIR)
+      path_string = os.path.relpath(path_string, ROOT_DIR)
 
     if not path_string.endswith('.gyp'):
       # Assume this is a path to the containing directory and infer the gypfile.
-      default_gypfile = cls._GetDefaultGypFile(path_string)
-      if default_gypfile:
-        return default_gypfile
-      else:
-        return None
+      return cls._GetDefaultGypFile(path_string, verify=verify)
+    if verify and not _IsFile(os.path.join(ROOT_DIR, path_string)):
+      return None
     return path_string
 
   @classmethod
-  def _GetDefaultGypFile(cls, working_directory):
+  def _GetDefaultGypFile(cls, working_directory, verify=False):
     """Returns the default gypfile to build for the given directory.
 
     This function returns a path to a gypfile at the top level of
     working_directory whose name is the same as the directory's.  So for
     example, if working_directory is "/path/to/ion", it will return
-    "/path/to/ion/ion.gyp".  This path is returned even if it does not actually
-    exist in the file system.
+    "/path/to/ion/ion.gyp".  Unless verify is set, this path is returned even if
+    it does not actually exist in the file system.
 
     Args:
       working_directory: The directory that the default gypfile should be
-          returned for.
+          returned for, relative to ROOT_DIR.
+      verify: Whether to return None if the gypfile does not exist.
 
     Returns:
-      The gypfile that should be built by default for the given directory.
+      The gypfile that should be built by default for the given directory, or
+      None if verify is set and it does not exist.
     """
     working_directory = working_directory.rstrip(os.sep)
     barename = os.path.basename(working_directory)
-    return os.path.join(working_directory, '{0}.gyp'.format(barename))
+    gypfile = os.path.join(working_directory, '{0}.gyp'.format(barename))
+    if verify and not _IsFile(os.path.join(ROOT_DIR, gypfile)):
+      return None
+    return gypfile
 
   def _ParseCommandLineArgs(self, argv):
     """Parses command line arguments and shows help/usage if necessary.
@@ -1885,44 +2271,48 @@ class BuildState(object):
       values, followed by a list of positional arguments.  (This is the same
       tuple returned by argparse.ArgumentParser.parse_args.)
     """
+    wants_help = '-h' in argv[1:] or '--help' in argv[1:]
+
     # Load the registry of builders that have been annotated with
     # @RegisterBuilder and determine what OSes and configurations we know how to
-    # build.  This information is displayed if the --help option is found.
-    available_builds = []
-    unavailable_builds = []
-
-    this_os = GetHostOS()
-
-    self.all_configs_ = self._FindAllConfigurations()
-    for key, builder in BUILDER_REGISTRY.items():
-      target_os, generator = key
-      can_build = this_os in builder.POSSIBLE_HOST_OS
-      if can_build:
-        style = colorama.Style.RESET_ALL
-      else:
-        style = colorama.Style.DIM
-
-      if generator:
-        os_and_configs = '{2}{0} ({1}): '.format(target_os, generator, style)
-      else:
-        os_and_configs = '{1}{0}: '.format(target_os, style)
-
-      os_and_configs += ', '.join(
-          self.all_configs_[builder.TARGET_OS, builder.TARGET_FLAVOR,
-                            builder.GYP_GENERATOR])
-      if can_build:
-        available_builds.append(os_and_configs)
-      else:
-        unavailable_builds.append(os_and_configs)
-    all_builds = available_builds + unavailable_builds
+    # build.  This information is only displayed if the --help option is found,
+    # and finding the configurations of every builder means evaluating os.gypi
+    # for each of them, so skip it otherwise.
+    epilog = None
+    if wants_help:
+      available_builds = []
+      unavailable_builds = []
+
+      this_os = self.host_os
+      available_style = colorama.Style.RESET_ALL
+      unavailable_style = colorama.Style.DIM
+
+      for key, builder in BUILDER_REGISTRY.items():
+        target_os, generator = key
+        can_build = this_os in builder.POSSIBLE_HOST_OS
+        style = available_style if can_build else unavailable_style
+
+        if generator:
+          os_and_configs = '{2}{0} ({1}): '.format(target_os, generator, style)
+        else:
+          os_and_configs = '{1}{0}: '.format(target_os, style)
+
+        os_and_configs += ', '.join(
+            self.GetConfigurationsForOS(*builder.CONFIGURATIONS_KEY))
+        if can_build:
+          available_builds.append(os_and_configs)
+        else:
+          unavailable_builds.append(os_and_configs)
+      all_builds = available_builds + unavailable_builds
+      epilog = ('\nPossible OS and configuration values:\n  ' +
+                '\n  '.join(all_builds)) + '\n'
 
     # First pass: add options whose presence or default value doesn't depend on
     # any other arguments.  We create the parser without a --help option,
     # because if we added one and the user passed the option, ArgumentParser
     # would print usage and exit before performing the second pass.
     parser = argparse.ArgumentParser(
-        epilog=('\nPossible OS and configuration values:\n  ' +
-                '\n  '.join(all_builds)) + '\n',
+        epilog=epilog,
         formatter_class=argparse.RawDescriptionHelpFormatter,
         add_help=False)
     parser.add_argument(
@@ -1993,7 +2383,8 @@ class BuildState(object):
         '-c', '--configuration',
         default=None,
         help='What configuration to build. See below for available '
-        'configurations.')
+        'configurations. Pass a comma-separated list to build (and test) '
+        'several configurations; they are built in parallel.')
     parser.add_argument(
         '-g', '--generator',
         default=None,
@@ -2011,49 +2402,50 @@ class BuildState(object):
 
     # Parse only known args, since project-specific build flags will be
     # determined later.
-    args = parser.parse_known_args(argv[1:])
+    known_args, unknown_args = parser.parse_known_args(argv[1:])
 
     # Second pass: calculate the path to the gyp file the user wants to build,
     # and parse it looking for project-specific build flags we should add
     # options for.
-    if args and args[0].path:
-      self.filename_ = self._MakeGypFilePath(args[0].path)
-    elif os.path.isfile(os.path.join(ROOT_DIR,
-                                     self._MakeGypFilePath(os.getcwd()))):
-      self.filename_ = self._MakeGypFilePath(os.getcwd())
+    if known_args.path:
+      self.filename_ = self._MakeGypFilePath(known_args.path)
     else:
-      self.filename_ = None
+      self.filename_ = self._MakeGypFilePath(os.getcwd(), verify=True)
 
     self.possible_build_flags_ = {}
     if self.filename_:
-      self.possible_build_flags_ = self._FindBuildFlags(self.filename_)
-
-    if self.possible_build_flags_:
-      # We'll add the build flags to this group as options in a moment.
-      build_flags = parser.add_argument_group('build flags')
-    elif not self.filename_:
-      # The user didn't give us a gyp file, so we can only show generic help.
-      build_flags = parser.add_argument_group(
-          'build flags', 'To see project-specific flags, specify a gyp file.')
-    else:
-      # The gyp file was valid, but contained no build flags.
-      build_flags = parser.add_argument_group(
-          'build flags', 'No project-specific build flags are defined.')
-
-    # Add a new command-line option for each build flag we found.
-    for variable, default_value in self.GetPossibleBuildFlags().items():
-      # Default values that can be converted to integers are treated as such
-      # and other values (strings) are left as strings. Initially, all values
-      # were converted to integers but this would cause an exception if a
-      # non-int string was used as a default.
-      try:
-        default_converted = int(default_value)
-      except ValueError:
-        default_converted = default_value
-      build_flags.add_argument(
-          '--' + variable,
-          default=default_converted,
-          help='(default: %(default)s)')
+      # A build flag named like one of the options above could not be added to
+      # the parser, so it cannot be set from the command line.
+      reserved_names = set(vars(known_args))
+      reserved_names.add('help')
+      self.possible_build_flags_ = dict(
+          (variable, default_value) for variable, default_value
+          in self._FindBuildFlags(self.filename_).items()
+          if variable not in reserved_names)
+
+    # Only arguments the first pass left unrecognized can set a build flag, so
+    # unless help was requested, options for the build flags are only added if
+    # there are any. GetActiveBuildFlags() treats the flags without an option
+    # as having their default values.
+    if unknown_args or wants_help:
+      if self.possible_build_flags_:
+        # We'll add the build flags to this group as options in a moment.
+        build_flags = parser.add_argument_group('build flags')
+      elif not self.filename_:
+        # The user didn't give us a gyp file, so we can only show generic help.
+        build_flags = parser.add_argument_group(
+            'build flags', 'To see project-specific flags, specify a gyp file.')
+      else:
+        # The gyp file was valid, but contained no build flags.
+        build_flags = parser.add_argument_group(
+            'build flags', 'No project-specific build flags are defined.')
+
+      # Add a new command-line option for each build flag we found.
+      for variable, default_value in self.GetPossibleBuildFlags().items():
+        build_flags.add_argument(
+            '--' + variable,
+            default=_BuildFlagDefault(default_value),
+            help='(default: %(default)s)')
 
     # Add the help option now that our option list is complete.
     parser.add_argument('-h', '--help', action='help')
@@ -2064,22 +2456,28 @@ class BuildState(object):
 
 
 def GetHostOS():
-  return {
-      'Darwin': 'mac',
-      'Linux': 'linux',
-      'Windows': 'win',
-  }[platform.system()]
+  """Returns the name of the OS this script runs on, e.g. 'linux'.
+
+  The host cannot change while the script runs, so it is only looked up once.
+
+  Raises:
+    KeyError: if platform.system() returns an unknown OS.
+  """
+  global _HOST_OS
+  if _HOST_OS is None:
+    _HOST_OS = _HOST_OS_NAMES[platform.system()]
+  return _HOST_OS
 
 
 def ExitWithError(message):
-  print >> sys.stdout, '{1}ERROR:{2} {0}'.format(
-      message, colorama.Fore.RED, colorama.Fore.RESET)
+  sys.stdout.write(_ERROR_PREFIX + str(message) + '\n')
   sys.exit(1)
 
 
 def PrintStatus(message):
-  print '{green}INFO: {reset}{m}'.format(
-      m=message, green=colorama.Fore.GREEN, reset=colorama.Fore.RESET)
+  # A single write, so that status lines from concurrent builds (see
+  # TargetBuilder.RunAllConfigurations) do not run into each other.
+  sys.stdout.write(_STATUS_PREFIX + message + '\n')
 
 
 def main(argv):
@@ -2115,7 +2513,7 @@ def main(argv):
   elif not args.generator:  # User wants to use the default generator.
     # We didn't have a builder for this OS+generator combination.  Look for any
     # builders for this OS and take the first one we find.
-    for key in BUILDER_REGISTRY.iterkeys():
+    for key in BUILDER_REGISTRY:
       if key[0] == args.os:
         builder = BUILDER_REGISTRY[key](state)
         break
@@ -2131,8 +2529,8 @@ def main(argv):
 
   if args.deps:
     PrintStatus('Running gyp in deps mode...')
-    dump_dependency_json = DumpDependencyBuilder(
-        state, target_os=builder.TARGET_OS, target_flavor=builder.TARGET_FLAVOR)
+    dump_dependency_json = state.GetDumpDependencyBuilder(
+        builder.TARGET_OS, builder.TARGET_FLAVOR)
     dump_dependency_json.RunGyp(filename)
     return
 
@@ -2144,22 +2542,35 @@ def main(argv):
         # Nothing more to do, since no build target was specified.
         return 0
 
+    available_configurations = state.GetConfigurationsForOS(
+        builder.TARGET_OS, builder.TARGET_FLAVOR, builder.GYP_GENERATOR)
+    # Empty entries, e.g. from a trailing comma, are ignored. An empty
+    # configuration would otherwise build the whole output directory.
+    configurations = [configuration
+                      for configuration in (args.configuration or '').split(',')
+                      if configuration]
+    if not configurations:
+      # A configuration was not given in the options; use the default.
+      configurations = [available_configurations[0]]
+    # If os.gypi defines no configurations for the target, leave it to gyp to
+    # decide whether the given ones exist.
+    unknown_configurations = [configuration
+                              for configuration in configurations
+                              if configuration not in available_configurations]
+    if available_configurations and unknown_configurations:
+      ExitWithError('Unknown configuration(s) {0}; available: {1}'.format(
+          ', '.join(unknown_configurations),
+          ', '.join(available_configurations)))
+
     if not args.nogyp:
       PrintStatus('Running gyp...')
       gyp_retcode = builder.RunGyp(filename)
       if gyp_retcode:
         ExitWithError('gyp returned non-zero')
 
-    configuration = args.configuration
-
-    if configuration is None:
-      # A configuration was not given in the options; use the default.
-      configuration = state.GetConfigurationsForOS(
-          builder.TARGET_OS, builder.TARGET_FLAVOR, builder.GYP_GENERATOR)[0]
-
     if not args.nobuild:
       PrintStatus('Building...')
-      exitcode = builder.RunBuild(configuration, filename)
+      exitcode = builder.RunAllConfigurations(configurations, filename)
       if exitcode:
         ExitWithError('Build failed.')
       else:
@@ -2167,9 +2578,13 @@ def main(argv):
 
     if args.test or args.test_until_failure:
       PrintStatus('Testing...')
-      retcode = builder.RunTests(configuration, filename,
-                                 test_args=args.test_arg,
-                                 stop_on_failure=args.test_until_failure)
+      retcode = 0
+      for configuration in configurations:
+        retcode |= builder.RunTests(configuration, filename,
+                                    test_args=args.test_arg,
+                                    stop_on_failure=args.test_until_failure)
+        if retcode and args.test_until_failure:
+          break
       if retcode:
         ExitWithError('There were test failures.')
       else:
@@ -56,23 +56,30 @@ def main(argv):
       help='files with prefixes (e.g. "opt:path/to/file1")')
   options = parser.parse_args(argv[1:])
 
+  source_paths = []
   for f in options.files:
     prefix, source_path = f.split(':', 1)
+    if prefix == options.configuration:
+      source_paths.append(source_path)
 
-    if prefix != options.configuration:
-      continue
+  # Every file is copied directly into the destination, so it only needs to be
+  # created once.
+  if source_paths and not os.path.isdir(options.destination):
+    os.makedirs(options.destination)
 
+  for source_path in source_paths:
     dest_path = os.path.join(options.destination, os.path.basename(source_path))
 
     # Determine if we need to copy the file at all. This is a little
     # optimization to avoid copying a existing files that have not changed.
-    if os.path.isfile(dest_path) and filecmp.cmp(dest_path, source_path):
+    # Since copy2 preserves modification times, files copied by a previous run
+    # are recognized from their size and modification time alone; the contents
+    # are only compared if those differ but the sizes do not.
+    dest_exists = os.path.isfile(dest_path)
+    if dest_exists and filecmp.cmp(dest_path, source_path, shallow=True):
       continue
 
-    if not os.path.isdir(os.path.dirname(dest_path)):
-      os.makedirs(os.path.dirname(dest_path))
-
-    if os.path.isfile(dest_path):
+    if dest_exists:
       # On windows, we have issues copying files if they exist and are
       # read-only, so chmod first.
       if not os.access(dest_path, os.W_OK):
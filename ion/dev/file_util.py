@@ -0,0 +1,43 @@
+#
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""File helpers shared by the build scripts in this directory."""
+
+import os
+
+
+def HasContents(path, contents):
+  """Returns whether the file at path exists and holds exactly contents.
+
+  Scripts use this to leave an up to date output untouched, so that its
+  timestamp does not make the build redo the work that depends on it. The file
+  is only read if its size matches, so a stale file usually costs a single stat.
+
+  This depends on the build tool: leaving the output of a build action
+  untouched is only safe if the tool rechecks its timestamp after running the
+  action, as ninja does. Other tools, e.g. make or xcode, would see the output
+  as older than its inputs and rerun the action on every build.
+
+  Args:
+    path: string - the file to check.
+    contents: bytes - the expected contents.
+  """
+  try:
+    if os.stat(path).st_size != len(contents):
+      return False
+  except OSError:
+    return False
+  with open(path, 'rb') as f:
+    return f.read() == contents
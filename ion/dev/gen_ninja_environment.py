@@ -21,13 +21,45 @@ The file format is simply a set of environment variables in which to run things
 in. Use this to set the PATH to e.g. VC binaries, platform_sdk binaries, etc.
 """
 
-import optparse
+import argparse
+import errno
+import locale
 import os
-import StringIO
+
+import file_util
 
 NUL = chr(0)
 
 
+def _EnvironmentBlock(env):
+  """Returns the contents of an environment file for the given environment.
+
+  Args:
+    env: dict of environment variables. Values that are lists are assumed to be
+        lists of paths.
+
+  Returns:
+    The NUL-separated variables as bytes, in the format gyp's win-tool expects.
+  """
+  entries = []
+  for k, v in env.items():
+    if isinstance(v, list):
+      # Assume they are paths.
+      entries.append('='.join([k, os.pathsep.join(v)]))
+    else:
+      # Assume it's just a value.
+      entries.append('='.join((k, v)))
+
+  # Each entry is terminated by a NUL, and yes, the extra NUL at the end is
+  # necessary. See gyp's win-tool.py:_GetEnv() for details.
+  block = ''.join(entry + NUL for entry in entries) + NUL
+  if not isinstance(block, bytes):
+    # win-tool reads the file in text mode, so use the encoding it will decode
+    # the file with.
+    block = block.encode(locale.getpreferredencoding(False))
+  return block
+
+
 def DoMain(argv):
   """This is the entry point that's called when pymod_do_main is used in gyp.
 
@@ -37,17 +69,17 @@ def DoMain(argv):
   Returns:
     Command to run (which replaces the 'action' in the gyp target).
   """
-  parser = optparse.OptionParser()
-  parser.add_option('--environment_file_dir')
-  parser.add_option('--possible_configurations')
-  parser.add_option('--windows_path_dirs_x86')
-  parser.add_option('--windows_path_dirs_x64')
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--environment_file_dir')
+  parser.add_argument('--possible_configurations')
+  parser.add_argument('--windows_path_dirs_x86')
+  parser.add_argument('--windows_path_dirs_x64')
   # Some tools, such as rc.exe, expect to find "windows.h". Since rc.exe is
   # launched by gyp-win-tool (a wrapper for some common windows build tools), we
   # don't have access to its command line arguments. Instead we set the INCLUDE
   # environment variable (globally) so it can find windows.h.
-  parser.add_option('--windows_include_dirs')
-  options, _ = parser.parse_args(argv)
+  parser.add_argument('--windows_include_dirs')
+  options, _ = parser.parse_known_args(argv)
 
   environment_file_dir = options.environment_file_dir
   possible_configurations = options.possible_configurations.split(' ')
@@ -59,11 +91,12 @@ def DoMain(argv):
   lib_env = os.environ.get('LIB')
 
   # LIB is needed for VS2015, which uses a few files from the Windows 10 SDK
-  # even when targeting the Windows 8.1 SDK.
+  # even when targeting the Windows 8.1 SDK. SYSTEMROOT, TEMP and TMP are single
+  # directories rather than path lists, so they are passed through unchanged.
   default_env = {
-      'SYSTEMROOT': os.environ.get('SYSTEMROOT').split(os.pathsep),
-      'TEMP': os.environ.get('TEMP').split(os.pathsep),
-      'TMP': os.environ.get('TMP').split(os.pathsep),
+      'SYSTEMROOT': os.environ['SYSTEMROOT'],
+      'TEMP': os.environ['TEMP'],
+      'TMP': os.environ['TMP'],
       'PATH': os.environ.get('PATH').split(os.pathsep),
       'INCLUDE': (include_env.split(os.pathsep) if include_env else []) +
                  windows_includes,
@@ -80,39 +113,29 @@ def DoMain(argv):
   env_x86['PATH'] = windows_path_dirs_x86 + env_x86['PATH']
   env_x64['PATH'] = windows_path_dirs_x64 + env_x64['PATH']
 
-  for conf in possible_configurations:
-    for env, env_file_name in [(env_x86, 'environment.x86'),
-                               (env_x64, 'environment.x64')]:
-      env_file = os.path.join(environment_file_dir, conf, env_file_name)
-      # The directories might not exist yet, since this action is running as the
-      # very first target in the build process.
-      if not os.path.isdir(os.path.dirname(env_file)):
-        os.makedirs(os.path.dirname(env_file))
+  # The contents of the files are the same for every configuration.
+  env_blocks = [(_EnvironmentBlock(env_x86), 'environment.x86'),
+                (_EnvironmentBlock(env_x64), 'environment.x64')]
 
+  for conf in possible_configurations:
+    conf_dir = os.path.join(environment_file_dir, conf)
+    # The directories might not exist yet, since this action is running as the
+    # very first target in the build process.
+    try:
+      os.makedirs(conf_dir)
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
+
+    for env_block, env_file_name in env_blocks:
+      env_file = os.path.join(conf_dir, env_file_name)
       # It saves a lot of build time if we don't overwrite this file if it has
-      # not been modified.
-      existing_contents = None
-      if os.path.isfile(env_file):
-        with open(env_file, 'rb') as f:
-          existing_contents = f.read()
-
-      sio = StringIO.StringIO()
-      for k, v in env.items():
-        if isinstance(v, list):
-          # Assume they are paths.
-          sio.write('='.join([k, os.pathsep.join(v)]))
-        else:
-          # Assume it's just a value.
-          sio.write('='.join((k, v)))
-        sio.write(NUL)
-
-      # Yes, this last NUL is necessary. See gyp's win-tool.py:_GetEnv() for
-      # details.
-      sio.write(NUL)
-
-      if sio.getvalue() != existing_contents:
+      # not been modified. Unlike a build action's output (see
+      # file_util.HasContents), this is safe, since the files are written while
+      # gyp runs, and only the ninja generator uses them.
+      if not file_util.HasContents(env_file, env_block):
         with open(env_file, 'wb') as f:
-          f.write(sio.getvalue())
+          f.write(env_block)
 
   # This script is used in an 'action' block. The output from this command will
   # replace the contents of the action block, so we must return some dummy thing
@@ -40,6 +40,7 @@
           # to use when it's building.
           'action_name': 'generate_ninja_environment_files',
           'inputs': [
+            'file_util.py',
             'gen_ninja_environment.py',
           ],
           'outputs': [
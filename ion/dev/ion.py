@@ -19,6 +19,9 @@ This module contains functions that are used for building Ion and any
 projects that use Ion.
 """
 
+import ast
+import collections
+
 
 #------------------------------------------------------------------------------
 def ComputeLibraryDependencies(direct_lib_dict):
@@ -35,25 +38,35 @@ def ComputeLibraryDependencies(direct_lib_dict):
   Raises:
     Exception: if a cycle is found.
   """
-  ret_dict = {}
-  for cur_lib in direct_lib_dict.keys():
-    # Gather all libraries cur_lib depends on into all_libs.
-    libs_to_process = [cur_lib]
+  closures = {}
+  visiting = set()  # For detecting cycles.
+
+  def _Closure(lib):
+    """Returns the dependencies of lib, computing them only once per lib."""
+    if lib in closures:
+      return closures[lib]
+    if lib in visiting:
+      raise Exception('ComputeLibraryDependencies found a cycle at lib "' +
+                      lib + '"')
+    visiting.add(lib)
     all_libs = []
-    while libs_to_process:
-      lib = libs_to_process.pop(0)
-      if lib != cur_lib:
-        all_libs.append(lib)
-      if lib in direct_lib_dict:
-        # Add all dependencies to the list to process if not already done.
-        dep_libs = direct_lib_dict[lib]
-        if lib in dep_libs:
-          raise Exception('ComputeLibraryDependencies found a cycle at lib "' +
-                          lib + '"')
-        libs_to_process += [dep_lib for dep_lib in dep_libs
-                            if dep_lib not in all_libs]
-    ret_dict[cur_lib] = all_libs
-  return ret_dict
+    for dep_lib in direct_lib_dict.get(lib, []):
+      all_libs.append(dep_lib)
+      all_libs.extend(_Closure(dep_lib))
+    # A library must come before all the libraries it depends on, so if it can
+    # be reached along several paths only its last occurrence is kept.
+    seen = set()
+    closure = []
+    for dep_lib in reversed(all_libs):
+      if dep_lib not in seen:
+        seen.add(dep_lib)
+        closure.append(dep_lib)
+    closure.reverse()
+    visiting.remove(lib)
+    closures[lib] = closure
+    return closure
+
+  return {lib: _Closure(lib) for lib in direct_lib_dict}
 
 
 #------------------------------------------------------------------------------
@@ -71,26 +84,37 @@ def TopologicalSort(d):
   Raises:
     Exception: if a cycle is found.
   """
-  visited = []
+  # Count the incoming edges of every node, including nodes that only appear
+  # as the target of an edge. The nodes are listed in the order they are found,
+  # so that the result is deterministic for a given dictionary.
+  nodes = []
+  in_degrees = {}
+  for key, edges in d.items():
+    if key not in in_degrees:
+      in_degrees[key] = 0
+      nodes.append(key)
+    for edge in edges:
+      if edge in in_degrees:
+        in_degrees[edge] += 1
+      else:
+        in_degrees[edge] = 1
+        nodes.append(edge)
+
+  # Repeatedly take a node that nothing points to any more (Kahn's algorithm).
+  ready = collections.deque(node for node in nodes if not in_degrees[node])
   sorted_nodes = []
-  visiting = []  # For detecting cycles.
-
-  def _Search(key):
-    if key not in visited:
-      if key in visiting:
-        raise Exception('TopologicalSort found a cycle at key "' + key + '"')
-      visiting.append(key)
-      for edge in d.get(key, []):
-        _Search(edge)
-      visited.append(key)
-      sorted_nodes.append(key)
-      visiting.remove(key)
-
-  for key in d.keys():
-    _Search(key)
-
-  # The DFS puts the leaves in the list first, so reverse it.
-  sorted_nodes.reverse()
+  while ready:
+    node = ready.popleft()
+    sorted_nodes.append(node)
+    for edge in d.get(node, []):
+      in_degrees[edge] -= 1
+      if not in_degrees[edge]:
+        ready.append(edge)
+
+  # Nodes on a cycle never run out of incoming edges.
+  if len(sorted_nodes) != len(nodes):
+    key = next(node for node in nodes if in_degrees[node])
+    raise Exception('TopologicalSort found a cycle at key "' + key + '"')
   return sorted_nodes
 
 
@@ -105,4 +129,6 @@ def LoadDependencyDictionary(filename):
     A dictionary in which each entry key is a library name and the value is a
     list of all libraries on which that library depends on.
   """
-  return eval(open(filename, 'r').read())
+  # The file only holds a literal, so there is no need to run it as code.
+  with open(filename, 'r') as f:
+    return ast.literal_eval(f.read())
@@ -65,12 +65,40 @@ From gyp:
 """
 
 
+import ast
 import optparse
 import os
 import re
 import sys
 
 
+def _ReplacePatterns(text, replacement_mapping):
+  """Replaces the matches of each regex in replacement_mapping in text.
+
+  The patterns are applied one after another, in the order of the mapping, so
+  a pattern sees the text as left by the ones before it.
+
+  Args:
+    text: The text to replace strings in.
+    replacement_mapping: Dict mapping regex patterns to their replacements.
+
+  Returns:
+    The text with all the replacements made.
+  """
+  # Treat each pattern as a regex, with re.DOTALL (meaning dot captures
+  # newlines). To prevent . from being greedy, use a "?". E.g.:
+  #
+  # 'remove: {.*?}' will correctly handle:
+  #
+  # 'remove: { things we want removed }  { things we want to keep }'
+  #
+  # because the . stops at the first '}'. See:
+  # https://docs.python.org/2/library/re.html#regular-expression-syntax
+  for from_pattern, to_text in replacement_mapping.items():
+    text = re.compile(from_pattern, re.DOTALL).sub(to_text, text)
+  return text
+
+
 def main(argv):
   """Entry point.
 
@@ -90,26 +118,19 @@ def main(argv):
   replacement_mapping = {}
   if options.replacement_mapping is not None:
     with open(options.replacement_mapping, 'r') as m:
-      replacement_mapping = eval(m.read())
+      replacement_mapping = ast.literal_eval(m.read())
 
-  if options.output and not os.path.isdir(os.path.dirname(options.output)):
-    os.makedirs(os.path.dirname(options.output))
+  # Create the output directory before reading anything, so that a bad --output
+  # fails early. An output in the working directory has no directory to create.
+  output_dir = os.path.dirname(options.output or '')
+  if output_dir and not os.path.isdir(output_dir):
+    os.makedirs(output_dir)
 
   # We can't use options.input here, because 'input' is a python keyword.
   with open(getattr(options, 'input'), 'r') as input_:
     text = input_.read()
 
-  for from_pattern, to_text in replacement_mapping.items():
-    # Treat from_pattern as a regex, with re.DOTALL (meaning dot captures
-    # newlines). To prevent . from being greedy, use a "?". E.g.:
-    #
-    # 'remove: {.*?}' will correctly handle:
-    #
-    # 'remove: { things we want removed }  { things we want to keep }'
-    #
-    # because the . stops at the first '}'. See:
-    # https://docs.python.org/2/library/re.html#regular-expression-syntax
-    text = re.sub(re.compile(from_pattern, re.DOTALL), to_text, text)
+  text = _ReplacePatterns(text, replacement_mapping)
 
   for from_text, to_text in zip(getattr(options, 'from'), options.to):
     text = text.replace(from_text, to_text)
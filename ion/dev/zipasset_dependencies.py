@@ -38,6 +38,30 @@ import sys
 import zipasset_generator
 
 
+def _ListAssets(iad_file, default_search_paths, search_path):
+  """Returns the paths to the assets in an IAD file, relative to search_path.
+
+  Args:
+    iad_file: The IAD file to list the assets of.
+    default_search_paths: Tuple of paths to search for the assets in, after the
+        directory containing iad_file.
+    search_path: The path the returned paths are relative to.
+
+  Returns:
+    List of the paths to the assets, using forward slashes.
+  """
+  # Add the absolute path to the IAD file as the primary search path for the
+  # manifest.
+  search_paths = [os.path.dirname(os.path.abspath(iad_file))]
+  search_paths.extend(default_search_paths)
+
+  _, _, manifest = zipasset_generator.BuildManifest(iad_file, search_paths)
+  # Windows requires replacing backslashes (given by the os module implicitly)
+  # with forward slashes.
+  return [os.path.relpath(abs_path_to_asset, search_path).replace('\\', '/')
+          for abs_path_to_asset, _ in manifest]
+
+
 def main():
   parser = argparse.ArgumentParser(
       usage='Usage: %prog --iads "<asset definition files>" '
@@ -52,34 +76,29 @@ def main():
 
   # iads can be empty, but it can't be completely unset.
   if options.iads is None:
-    print 'Need --iads'
+    print('Need --iads')
     return 1
 
   if not options.search_path:
-    print 'Need --search_path'
+    print('Need --search_path')
     return 1
 
   # Set up additional search paths.
-  path_to_script = os.path.abspath(os.path.dirname(__file__))
   # Assume that the 'ion' directory is top-level.
   root_path = os.path.join(os.path.dirname(__file__), '..', '..')
   root_path = os.path.abspath(root_path)
-  default_search_paths = [root_path, os.path.abspath(options.search_path)]
-
-  # Note that --iads is given as one big space-separated string.
+  # The asset paths are made relative to the absolute search path, so that
+  # relpath does not have to look up the working directory for every asset.
+  search_path = os.path.abspath(options.search_path)
+  default_search_paths = (root_path, search_path)
+
+  # Note that --iads is given as one big space-separated string. Each IAD's
+  # assets are written as soon as they are listed, so that if a later IAD has
+  # an error, the assets of the ones before it are still printed.
   for iad_file in options.iads.split():
-    # Add the absolute path to the IAD file as the primary search path for the
-    # manifest.
-    search_paths = default_search_paths[:]
-    search_paths.insert(0, os.path.dirname(os.path.abspath(iad_file)))
-
-    _, _, manifest = zipasset_generator.BuildManifest(iad_file, search_paths)
-    for abs_path_to_asset, _ in manifest:
-      rel_path_to_asset = os.path.relpath(
-          abs_path_to_asset, options.search_path)
-      # Windows requires replacing backslashes (given by the os module
-      # implicitly) with forward slashes.
-      print rel_path_to_asset.replace('\\', '/')
+    asset_list = _ListAssets(iad_file, default_search_paths, search_path)
+    sys.stdout.write(''.join(rel_path_to_asset + '\n'
+                             for rel_path_to_asset in asset_list))
 
 
 if __name__ == '__main__':
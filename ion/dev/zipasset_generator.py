@@ -71,13 +71,16 @@ ZipAssetManager.
 
 
 import array
+import collections
+import io
+import mmap
 import os
-import StringIO
 import sys
-import textwrap
 import xml.etree.ElementTree as ET
 import zipfile
 
+import file_util
+
 
 class Error(Exception):
   """Base class for errors."""
@@ -87,12 +90,50 @@ class InvalidAssetSyntaxError(Error):
   """Error representing an asset file with invalid syntax."""
 
 
+# Passed by zipasset_generator.gypi when the build tool rechecks the timestamps
+# of an action's outputs after running it. See GenerateZipAsset.
+_KEEP_UNCHANGED_OUTPUT_FLAG = '--keep_unchanged_output'
+
+# The normcased names in each directory searched for assets, keyed by directory.
+# See _ListDirectory.
+_DIRECTORY_LISTINGS = {}
+
+
+#------------------------------------------------------------------------------
+def _ListDirectory(directory):
+  """Returns the set of normcased names in a directory.
+
+  Each directory is only read once, however many assets are looked up in it.
+
+  Args:
+    directory: string - the directory to list.
+
+  Returns:
+    A frozenset of names, which is empty if the directory cannot be read.
+  """
+  names = _DIRECTORY_LISTINGS.get(directory)
+  if names is None:
+    try:
+      names = frozenset(os.path.normcase(name)
+                        for name in os.listdir(directory))
+    except OSError:
+      names = frozenset()
+    _DIRECTORY_LISTINGS[directory] = names
+  return names
+
+
 #------------------------------------------------------------------------------
 def GetPathToAsset(asset, search_paths):
-  """Builds a list of (filename, asset) pairs from an asset file.
+  """Finds an asset file, either directly or in one of the search paths.
+
+  Rather than stat'ing the asset in each search path, the directories it could
+  be in are listed, so that assets sharing a directory share a single read. The
+  listings hold names as they are spelled on disk, so if none of them has the
+  asset, e.g. because it is spelled differently on a case-insensitive
+  filesystem, each search path is checked directly.
 
   Args:
-    asset: string - a file to search for.
+    asset: string - a normcased file to search for.
     search_paths: list of strings - paths to search for asset files
 
   Returns:
@@ -100,11 +141,15 @@ def GetPathToAsset(asset, search_paths):
   """
   if os.path.exists(asset):
     return asset
-  else:
-    for path in search_paths:
-      asset_filename = os.path.join(path, asset)
-      if os.path.exists(asset_filename):
-        return asset_filename
+  asset_dir, asset_name = os.path.split(asset)
+  for path in search_paths:
+    directory = os.path.normpath(os.path.join(path, asset_dir))
+    if asset_name in _ListDirectory(directory):
+      return os.path.join(path, asset)
+  for path in search_paths:
+    asset_path = os.path.join(path, asset)
+    if os.path.isfile(asset_path):
+      return asset_path
   return None
 
 
@@ -148,21 +193,37 @@ def BuildManifest(asset_file, search_paths):
   if not os.path.exists(asset_file):
     raise IOError('Could not find asset file "%s"' % asset_file)
 
-  # Load the xml.
-  root = ET.parse(asset_file).getroot()
-  if root.tag != 'IAD':
-    raise InvalidAssetSyntaxError('Root tag should be "IAD" not "%s"' %
-                                  root.tag)
-  if 'name' not in root.attrib:
-    raise InvalidAssetSyntaxError('Root tag requires a "name" attribute')
-
-  disable_in_prod = root.attrib.get('disable_in_prod', 'false') == 'true'
-
+  # Walk the xml as it is parsed, rather than building the whole tree first and
+  # then searching it. Only <assets> directly inside the root and <file>
+  # directly inside those are considered.
+  root = None
+  prefix = None
+  depth = 0
   manifest = []
-  for group in root.findall('assets'):
-    # Get the path prefix if there is one.
-    prefix = group.attrib['prefix'] if 'prefix' in group.attrib else ''
-    for asset in group.findall('file'):
+  for event, element in ET.iterparse(asset_file, events=('start', 'end')):
+    if event == 'start':
+      depth += 1
+      if depth == 1:
+        root = element
+        if root.tag != 'IAD':
+          raise InvalidAssetSyntaxError('Root tag should be "IAD" not "%s"' %
+                                        root.tag)
+        if 'name' not in root.attrib:
+          raise InvalidAssetSyntaxError('Root tag requires a "name" attribute')
+      elif depth == 2 and element.tag == 'assets':
+        # Get the path prefix if there is one.
+        prefix = element.attrib.get('prefix', '')
+      continue
+
+    depth -= 1
+    if depth == 1:
+      # The end of a child of the root, e.g. a group whose files have all been
+      # added. It is not needed any more.
+      prefix = None
+      element.clear()
+    elif depth == 2 and prefix is not None and element.tag == 'file':
+      # The text of an element is only known to be complete at its end.
+      asset = element
       # See if the file exists.
       asset_filename = GetPathToAsset(os.path.normcase(asset.text),
                                       search_paths)
@@ -176,11 +237,40 @@ def BuildManifest(asset_file, search_paths):
           prefix,
           asset.attrib['name'] if 'name' in asset.attrib else asset.text)
       # Add the full path to the file to the manifest.
-      manifest += [(os.path.abspath(asset_filename), filename)]
+      manifest.append((os.path.abspath(asset_filename), filename))
 
+  disable_in_prod = root.attrib.get('disable_in_prod', 'false') == 'true'
   return root.attrib['name'], disable_in_prod, manifest
 
 
+#------------------------------------------------------------------------------
+def _MapFile(path):
+  """Returns the contents of a file, mapped into memory if possible.
+
+  Mapping the file avoids copying its contents into a string before they are
+  compressed.
+
+  Args:
+    path: string - the file to map.
+
+  Returns:
+    A read-only mmap.mmap of the file, or a string holding its contents if it
+    cannot be mapped (e.g. because it is empty). Close it with _CloseFile.
+  """
+  with open(path, 'rb') as f:
+    try:
+      return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, EnvironmentError):
+      return f.read()
+
+
+#------------------------------------------------------------------------------
+def _CloseFile(data):
+  """Closes file contents returned by _MapFile."""
+  if isinstance(data, mmap.mmap):
+    data.close()
+
+
 #------------------------------------------------------------------------------
 def BuildAssetZip(asset_file, search_paths):
   """Reads an asset definition file and builds a zip file in memory.
@@ -193,7 +283,7 @@ def BuildAssetZip(asset_file, search_paths):
     A tuple containing:
       - an asset name
       - boolean, representing disable_in_prod
-      - a StringIO object that holds a memory zip file containing the assets and
+      - a BytesIO object that holds a memory zip file containing the assets and
         a manifest file.
 
   Raises:
@@ -204,60 +294,122 @@ def BuildAssetZip(asset_file, search_paths):
     raise InvalidAssetSyntaxError(
         '"%s" does not contain any asset definitions' % asset_file)
 
-  in_memory_zip = StringIO.StringIO()
+  in_memory_zip = io.BytesIO()
   zip_file = zipfile.ZipFile(in_memory_zip, 'w',
                              compression=zipfile.ZIP_DEFLATED)
 
   # Use a dummy time so that the generated zip data is deterministic even if
   # built across distributed machines.
   dummy_date = (2017, 1, 1, 1, 0, 0)
+  # Python 3 gives files without attributes read-write owner permissions, so
+  # set those explicitly to get the same zip data from either version.
+  file_attr = 0o600 << 16
   # Keep track of what the absolute path is for each file in the zip.
-  manifest_file = StringIO.StringIO()
+  manifest_lines = []
+  # The same file can be added several times under different names. Keep the
+  # contents of those files around, so each one is only mapped once. Other files
+  # are closed right away, so that large IADs do not run out of descriptors.
+  name_counts = collections.Counter(local_name for local_name, _ in manifest)
+  shared_data = {}
   # Write each file to the zip using the manifest name.
   original_size = 0
-  for (local_name, zip_name) in manifest:
-    original_size += os.path.getsize(local_name)
-    internal_name = zip_name.lstrip('/')
-    info = zipfile.ZipInfo(internal_name, dummy_date)
-    with open(local_name, 'rb') as f:
-      data = f.read()
-      zip_file.writestr(info, data, zipfile.ZIP_DEFLATED)
-    manifest_file.write('%s|%s\n' % (zip_name,
-                                     GetIdentifyingAssetPath(local_name)))
-
-  # Write the special manifest file.
+  try:
+    for (local_name, zip_name) in manifest:
+      internal_name = zip_name.lstrip('/')
+      info = zipfile.ZipInfo(internal_name, dummy_date)
+      info.external_attr = file_attr
+      data = shared_data.get(local_name)
+      if data is None:
+        data = _MapFile(local_name)
+        if name_counts[local_name] > 1:
+          shared_data[local_name] = data
+      try:
+        # The explicit compression type is needed, since a ZipInfo passed to
+        # writestr() would otherwise be stored uncompressed.
+        zip_file.writestr(info, data, zipfile.ZIP_DEFLATED)
+        original_size += len(data)
+      finally:
+        if local_name not in shared_data:
+          _CloseFile(data)
+      manifest_lines.append('%s|%s\n' % (zip_name,
+                                         GetIdentifyingAssetPath(local_name)))
+  finally:
+    for data in shared_data.values():
+      _CloseFile(data)
+
+  # Write the special manifest file. writestr() stores text as UTF-8.
   info = zipfile.ZipInfo('__asset_manifest__.txt', dummy_date)
-  zip_file.writestr(info, manifest_file.getvalue(), zipfile.ZIP_DEFLATED)
+  info.external_attr = file_attr
+  zip_file.writestr(info, ''.join(manifest_lines), zipfile.ZIP_DEFLATED)
   zip_file.close()
 
   # Pad the zip if it is not 4-byte aligned since we will encode it as 32-bit
   # integers.
-  remainder = len(in_memory_zip.getvalue()) % 4
+  compressed_size = in_memory_zip.seek(0, io.SEEK_END)
+  remainder = compressed_size % 4
   if remainder != 0:
-    in_memory_zip.write('\0' * (4 - remainder))
+    in_memory_zip.write(b'\0' * (4 - remainder))
+    compressed_size += 4 - remainder
 
   # Print out useful statistics prettily if running interactively.
   if sys.stdout.isatty():
     suffix_index = 0
     levels = ['', 'k', 'M', 'G', 'T']
-    compressed_size = in_memory_zip.len
+    # The ratio is computed before the sizes are rounded down to the suffix.
+    ratio = 100.0 * compressed_size / original_size
     min_size = min(compressed_size, original_size)
     while min_size > 1024:
-      min_size /= 1024
-      original_size /= 1024
-      compressed_size /= 1024
+      min_size //= 1024
+      original_size //= 1024
+      compressed_size //= 1024
       suffix_index += 1
-      suffix = levels[suffix_index]
+    suffix = levels[suffix_index]
 
-    print ('Created ZipAsset %s: compressed %d%sB -> %d%sB (%.0f%%)' %
-           (name, original_size, suffix, compressed_size, suffix,
-            (100 * compressed_size) / original_size))
+    print('Created ZipAsset %s: compressed %d%sB -> %d%sB (%.0f%%)' %
+          (name, original_size, suffix, compressed_size, suffix, ratio))
 
   return name, disable_in_prod, in_memory_zip
 
 
 #------------------------------------------------------------------------------
-def GenerateZipAsset(asset_file, search_paths, source_name):
+def _FillWords(words, width, initial_indent, subsequent_indent):
+  """Fills words into lines no longer than width, like textwrap.fill().
+
+  The words are already split, so unlike textwrap this does not have to search
+  the text for places to break it, which is slow for large assets.
+
+  Args:
+    words: list of strings - the words to fill, none of them longer than a line.
+    width: int - the maximum length of a line.
+    initial_indent: string - prepended to the first line.
+    subsequent_indent: string - prepended to all the other lines.
+
+  Returns:
+    The filled lines, joined by newlines.
+  """
+  lines = []
+  indent = initial_indent
+  line = []
+  line_length = 0
+  for word in words:
+    if not line:
+      line_length = len(indent) + len(word)
+    elif line_length + 1 + len(word) <= width:
+      line_length += 1 + len(word)
+    else:
+      lines.append(indent + ' '.join(line))
+      indent = subsequent_indent
+      line = []
+      line_length = len(indent) + len(word)
+    line.append(word)
+  if line:
+    lines.append(indent + ' '.join(line))
+  return '\n'.join(lines)
+
+
+#------------------------------------------------------------------------------
+def GenerateZipAsset(asset_file, search_paths, source_name,
+                     keep_unchanged_output=False):
   """Reads an asset definition file and produces asset files.
 
   The cc file contains a local static array defines a zip file of the files
@@ -267,88 +419,108 @@ def GenerateZipAsset(asset_file, search_paths, source_name):
     asset_file: string - a file containing asset definitions.
     search_paths: list of strings - paths to search for asset files
     source_name: string - the name of the output source file.
+    keep_unchanged_output: bool - whether to leave source_name untouched if it
+      already has the generated contents. Only pass True if the build tool
+      rechecks the timestamp of the output after running this (e.g. ninja,
+      whose gyp actions restat their outputs). Other build tools would see the
+      output as older than its inputs, and rerun this on every build.
   """
   asset_name, disable_in_prod, zipdata = BuildAssetZip(asset_file, search_paths)
 
-  # Write the source file that contains the array.
-  source = open(source_name, 'w')
+  # Assemble the source file that contains the array, and write it all at once.
+  source = []
 
   if disable_in_prod:
-    source.write('#if !ION_PRODUCTION\n\n')
+    source.append('#if !ION_PRODUCTION\n\n')
 
-  source.write('#include "ion/base/once.h"\n')
-  source.write('#include "ion/base/zipassetmanager.h"\n\n')
+  source.append('#include "ion/base/once.h"\n')
+  source.append('#include "ion/base/zipassetmanager.h"\n\n')
 
   # Write namespace. Use the name of the IAD.
-  source.write('namespace %s {\n\n' % asset_name)
+  source.append('namespace %s {\n\n' % asset_name)
 
   # Write function.
-  source.write('bool RegisterAssets() {\n')
-
-  # Write the zip data.
-  wrapper = textwrap.TextWrapper(initial_indent='  ', width=80,
-                                 subsequent_indent=' ' * 6)
+  source.append('bool RegisterAssets() {\n')
 
   # Encode the zip file as an array of unsigned ints to keep the file smaller
-  # and speed compilation time. Note that this works regardless of endian.
+  # and speed compilation time. The compiled array is read back as bytes on a
+  # little-endian target, so the values are always taken as little-endian,
+  # whatever the byte order of the machine running this script.
   ints = array.array('I', zipdata.getvalue())
-  data_string = ['static const unsigned int kData[] = { 0x%x' % ints[0]]
-  for value in ints[1:]:
-    data_string.append(', 0x%x' % value)
-  data_string.append(' };')
-  source.write(wrapper.fill(''.join(data_string)))
-  source.write('\n  return ::ion::base::ZipAssetManager::')
-  source.write('RegisterAssetData(\n')
-  source.write('      reinterpret_cast<const char*>(kData), sizeof(kData));\n')
-  source.write('}\n\n')
+  if sys.byteorder == 'big':
+    ints.byteswap()
+  # Format all of the values with a single % operation, rather than one per
+  # value.
+  values = (' '.join(['0x%x,'] * len(ints)) % tuple(ints)).split(' ')
+  # The last value is not followed by a comma.
+  values[-1] = values[-1][:-1]
+
+  # Write the zip data.
+  words = ['static', 'const', 'unsigned', 'int', 'kData[]', '=', '{']
+  words.extend(values)
+  words.append('};')
+  source.append(_FillWords(words, 80, '  ', ' ' * 6))
+  source.append('\n  return ::ion::base::ZipAssetManager::')
+  source.append('RegisterAssetData(\n')
+  source.append('      reinterpret_cast<const char*>(kData), sizeof(kData));\n')
+  source.append('}\n\n')
 
   # Write function that will only register assets once.
-  source.write('void RegisterAssetsOnce() {\n')
-  source.write('  ION_STATIC_ONCE_CHECKED(RegisterAssets);\n')
-  source.write('}\n\n')
+  source.append('void RegisterAssetsOnce() {\n')
+  source.append('  ION_STATIC_ONCE_CHECKED(RegisterAssets);\n')
+  source.append('}\n\n')
 
   # Close namespace.
-  source.write('}  // namespace %s\n' % asset_name)
+  source.append('}  // namespace %s\n' % asset_name)
 
   if disable_in_prod:
-    source.write('#endif\n\n')
+    source.append('#endif\n\n')
 
-  source.close()
+  source = ''.join(source).encode('utf-8')
+  # Leave an up to date source file untouched if allowed, so that it is not
+  # recompiled.
+  if not (keep_unchanged_output and
+          file_util.HasContents(source_name, source)):
+    with open(source_name, 'wb') as f:
+      f.write(source)
 
 
 #------------------------------------------------------------------------------
 def main():
-  if len(sys.argv) < 2:
-    print(('Usage: %s <asset definition file> <search path> '
-           '[[<generated source file>] <constituent file ...>]' % sys.argv[0]) +
+  keep_unchanged_output = _KEEP_UNCHANGED_OUTPUT_FLAG in sys.argv
+  argv = [arg for arg in sys.argv if arg != _KEEP_UNCHANGED_OUTPUT_FLAG]
+  if len(argv) < 2:
+    print(('Usage: %s [%s] <asset definition file> <search path> '
+           '[[<generated source file>] <constituent file ...>]' %
+           (argv[0], _KEEP_UNCHANGED_OUTPUT_FLAG)) +
           '  All files are relative to the directory in which this is run.')
   else:
     # Save the full absolute path to the input and output files.
     cur_dir = os.getcwd()
 
     # Set up additional search paths.
-    path_to_script = os.path.abspath(os.path.dirname(__file__))
     # Assume that the 'ion' directory is top-level.
     root_path = os.path.join(os.path.dirname(__file__), '..', '..')
     root_path = os.path.abspath(root_path)
     source_basedirs = []
-    if len(sys.argv) > 4:
+    if len(argv) > 4:
       source_basedirs = [
-          os.path.dirname(os.path.abspath(source)) for source in sys.argv[4:]
+          os.path.dirname(os.path.abspath(source)) for source in argv[4:]
       ]
     search_paths = [
-        os.path.dirname(os.path.abspath(sys.argv[1])), root_path,
-        os.path.abspath(sys.argv[2])
+        os.path.dirname(os.path.abspath(argv[1])), root_path,
+        os.path.abspath(argv[2])
     ] + list(set(source_basedirs))
 
-    asset_file_path = os.path.join(cur_dir, sys.argv[1])
+    asset_file_path = os.path.join(cur_dir, argv[1])
     output_file_path = (
-        os.path.join(cur_dir, sys.argv[3])
-        if len(sys.argv) >= 4 else asset_file_path + '.cc')
+        os.path.join(cur_dir, argv[3])
+        if len(argv) >= 4 else asset_file_path + '.cc')
     # Change to the directory containing the asset file so that relative paths
     # are correct.
     os.chdir(os.path.dirname(asset_file_path))
-    GenerateZipAsset(asset_file_path, search_paths, output_file_path)
+    GenerateZipAsset(asset_file_path, search_paths, output_file_path,
+                     keep_unchanged_output)
 
 
 if __name__ == '__main__':